@@ -0,0 +1,107 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from storage_redis import StorageRedis
+
+PREFIX = 'address_cache:'
+
+# coordinates are rounded to this amount of digits, about 10 meters
+PRECISION = 4
+
+# how long found addresses are kept (seconds)
+CACHE_TTL = 60 * 60 * 24 * 7
+
+# failed lookups are repeated not earlier than this (seconds)
+FAIL_TTL = 60
+
+# least recently used addresses are dropped from memory over this amount
+CACHE_SIZE = 10000
+
+Coordinates = Tuple[float, float]
+
+
+class AddressCache:
+    """
+    Addresses found by coordinates. Recent ones are kept in process, the
+    rest in redis shared by all bot processes. Close points share one
+    address.
+    """
+    @classmethod
+    async def create(cls, fail_value: str):
+        self = AddressCache(fail_value)
+        self._redis = await StorageRedis.create(PREFIX)
+        return self
+
+    def __init__(self, fail_value: str):
+        self._redis: StorageRedis
+        self._fail_value = fail_value
+
+        # key -> address, expiration time
+        self._recent: OrderedDict[str, Tuple[Optional[str], float]] = \
+            OrderedDict()
+
+        self._hits = {'memory': 0, 'redis': 0, 'miss': 0}
+
+    async def get(self,
+                  coordinates: Coordinates,
+                  language: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns whether the address is cached and the address itself,
+        which could be None for failed lookups
+        """
+        key = self._key(coordinates, language)
+        address, expires_at = self._recent.get(key, (None, 0.0))
+
+        if time.monotonic() < expires_at:
+            self._recent.move_to_end(key)
+            self._hits['memory'] += 1
+            return True, address
+
+        cached = await self._redis.get_value(key, None)
+
+        if cached is None:
+            self._hits['miss'] += 1
+            return False, None
+
+        self._hits['redis'] += 1
+        self._remember(key, cached['address'])
+        return True, cached['address']
+
+    async def set(self,
+                  coordinates: Coordinates,
+                  language: str,
+                  address: Optional[str]):
+        key = self._key(coordinates, language)
+        self._remember(key, address)
+
+        await self._redis.set_expiring_value(key,
+                                             {'address': address},
+                                             self._ttl(address))
+
+    def get_metrics(self) -> Dict[str, float]:
+        requests = sum(self._hits.values())
+        hits = self._hits['memory'] + self._hits['redis']
+
+        return {
+            **self._hits,
+            'in_memory': len(self._recent),
+            'hit_rate': round(hits / requests, 3) if requests else 0.0,
+        }
+
+    def _remember(self, key: str, address: Optional[str]):
+        self._recent[key] = (address, time.monotonic() + self._ttl(address))
+        self._recent.move_to_end(key)
+
+        while len(self._recent) > CACHE_SIZE:
+            self._recent.popitem(last=False)
+
+    def _ttl(self, address: Optional[str]) -> int:
+        if address is None or address == self._fail_value:
+            return FAIL_TTL
+
+        return CACHE_TTL
+
+    def _key(self, coordinates: Coordinates, language: str) -> str:
+        longitude, latitude = coordinates
+        return f'{language}:{longitude:.{PRECISION}f}:{latitude:.{PRECISION}f}'
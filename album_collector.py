@@ -0,0 +1,44 @@
+import asyncio
+from typing import Dict, List, Tuple
+
+from aiogram import types
+
+# album is considered complete if no new photos came in this time (seconds)
+ALBUM_WAIT = 1
+
+
+class AlbumCollector:
+    """
+    Telegram sends every photo of an album as a separate message. Collector
+    gathers them, so an album could be processed at once.
+    """
+    def __init__(self, wait: float = ALBUM_WAIT):
+        self._wait = wait
+        self._albums: Dict[Tuple[int, str], List[types.Message]] = dict()
+
+    async def collect(self, message: types.Message) -> List[types.Message]:
+        """
+        Returns all messages of the album to the handler of its first
+        message and an empty list to handlers of the rest. Message out of
+        any album is returned as is.
+        """
+        if not message.media_group_id:
+            return [message]
+
+        key = (message.chat.id, message.media_group_id)
+
+        if key in self._albums:
+            self._albums[key].append(message)
+            return []
+
+        album = self._albums[key] = [message]
+        size = 0
+
+        # wait until album stops growing
+        while size != len(album):
+            size = len(album)
+            await asyncio.sleep(self._wait)
+
+        self._albums.pop(key)
+        album.sort(key=lambda album_message: album_message.message_id)
+        return album
@@ -0,0 +1,38 @@
+from typing import Any, Dict
+
+import config
+from storage_redis import StorageRedis
+
+PREFIX = 'appeal_storage:'
+
+
+class AppealStorage:
+    """
+    Stores composed appeals outside of users data. Appeals are big and
+    needed only while being sent, so they are compressed and expire.
+    """
+    @classmethod
+    async def create(cls):
+        self = AppealStorage()
+        self._redis = await StorageRedis.create(PREFIX)
+        return self
+
+    def __init__(self):
+        self._redis: StorageRedis
+
+    async def add(self, user_id: int, appeal_id: int, appeal: Dict[str, Any]):
+        await self._redis.set_compressed_value(
+            self._key(user_id, appeal_id),
+            appeal,
+            config.APPEAL_STORAGE_TTL)
+
+    async def get(self, user_id: int, appeal_id: int) -> Dict[str, Any]:
+        return await self._redis.get_compressed_value(
+            self._key(user_id, appeal_id),
+            {})
+
+    async def delete(self, user_id: int, appeal_id: int):
+        await self._redis.delete(self._key(user_id, appeal_id))
+
+    def _key(self, user_id: int, appeal_id: int) -> str:
+        return f'{str(user_id)}:{str(appeal_id)}'
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from bot_storage import BotStorage
+
+logger = logging.getLogger(__name__)
+
+# cached ban checks are trusted for this time even without notifications
+# about changes (seconds)
+CACHE_TTL = 600
+
+# the whole cache is dropped when it grows over this amount of users
+CACHE_SIZE = 10000
+
+# pause before resubscribing after connection loss (seconds)
+RESUBSCRIBE_PAUSE = 5
+
+
+class BanList:
+    """
+    Ban checks cached in process. Any bot process changing bans notifies
+    the others through redis pub/sub, so their caches are dropped.
+    """
+    def __init__(self, bot_storage: BotStorage):
+        self._storage = bot_storage
+
+        # user id -> ban caption or None, time of the check
+        self._checks: Dict[str, Tuple[Optional[str], float]] = dict()
+
+        # changed on every invalidation, checks started before it could
+        # read outdated bans and aren't cached
+        self._generation = 0
+
+    async def start(self):
+        while True:
+            try:
+                await self._listen_to_changes()
+            except Exception:
+                logger.exception('Потеряли подписку на изменения банов')
+
+            self._invalidate()
+            await asyncio.sleep(RESUBSCRIBE_PAUSE)
+
+    async def get_caption(self, user_id: int) -> Optional[str]:
+        """
+        Returns ban caption or None if user isn't banned
+        """
+        key = str(user_id)
+        caption, checked_at = self._checks.get(key, (None, 0.0))
+
+        if time.monotonic() - checked_at < CACHE_TTL:
+            return caption
+
+        generation = self._generation
+        caption = await self._storage.get_ban(key)
+
+        if generation != self._generation:
+            return caption
+
+        if len(self._checks) >= CACHE_SIZE:
+            self._checks.clear()
+
+        self._checks[key] = (caption, time.monotonic())
+        return caption
+
+    async def get_all(self) -> Dict[str, str]:
+        return await self._storage.get_bans()
+
+    async def ban(self, user_id: str, caption: str):
+        await self._storage.add_ban(user_id, caption)
+        self._invalidate(user_id)
+
+    async def unban(self, user_id: str):
+        await self._storage.delete_ban(user_id)
+        self._invalidate(user_id)
+
+    async def _listen_to_changes(self):
+        channel = await self._storage.subscribe_to_bans_changes()
+
+        # changes made before the subscription could be missed
+        self._invalidate()
+
+        while await channel.wait_message():
+            user_id = await channel.get_json()
+            self._invalidate(str(user_id))
+
+    def _invalidate(self, user_id: Optional[str] = None):
+        """
+        Drops cached check of the user or all of them
+        """
+        self._generation += 1
+
+        if user_id is None:
+            self._checks.clear()
+        else:
+            self._checks.pop(user_id, None)
@@ -1,13 +1,106 @@
 import logging
-from asyncio import Semaphore
-from contextlib import asynccontextmanager
-from typing import Any, Dict
+from datetime import date as date_cls
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple, Union
+
+from aioredis import Channel
 
 from datetime_parser import get_today
-from storage_redis import StorageRedis
+from storage_redis import StorageRedis, decode_value
 
 PREFIX = "bot_storage:"
-semaphore = Semaphore()
+
+# how long to keep per-day appeals counters
+DAY_COUNT_TTL = int(timedelta(days=400).total_seconds())
+
+# user id -> ban caption
+BANS = 'bans'
+BANS_CHANNEL = 'bans_changed'
+
+TASKS_QUEUE = 'scheduled_tasks_queue'
+TASKS_PROCESSING = 'scheduled_tasks_processing'
+TASKS_PAYLOADS = 'scheduled_tasks_payloads'
+TASKS_ATTEMPTS = 'scheduled_tasks_attempts'
+TASKS_KEYS = [TASKS_QUEUE, TASKS_PROCESSING, TASKS_PAYLOADS, TASKS_ATTEMPTS]
+
+# KEYS - TASKS_KEYS
+# puts task back to the queue or drops it if attempts are exhausted,
+# task which was replaced by a newer one with the same id is just forgotten
+RELEASE_TASK = """
+local function release(id, execute_at, max_attempts)
+    redis.call('ZREM', KEYS[2], id)
+
+    if redis.call('ZSCORE', KEYS[1], id) then
+        return 0
+    end
+
+    local attempts = tonumber(redis.call('HGET', KEYS[4], id) or 0)
+
+    if attempts >= tonumber(max_attempts) then
+        redis.call('HDEL', KEYS[3], id)
+        redis.call('HDEL', KEYS[4], id)
+        return 0
+    end
+
+    redis.call('ZADD', KEYS[1], execute_at, id)
+    return 1
+end
+"""
+
+# ARGV - current time, limit, lease expiration time, max attempts
+# returns flat list of claimed task ids and payloads
+CLAIM_DUE_TASKS = RELEASE_TASK + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+
+for _, id in ipairs(expired) do
+    release(id, ARGV[1], ARGV[4])
+end
+
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'LIMIT', 0, ARGV[2])
+local claimed = {}
+
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local payload = redis.call('HGET', KEYS[3], id)
+
+    if payload then
+        redis.call('ZADD', KEYS[2], ARGV[3], id)
+        redis.call('HINCRBY', KEYS[4], id, 1)
+        table.insert(claimed, id)
+        table.insert(claimed, payload)
+    end
+end
+
+return claimed
+"""
+
+# ARGV - task id, next execution time, max attempts
+RETRY_TASK = RELEASE_TASK + """
+return release(ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# ARGV - task id
+ACKNOWLEDGE_TASK = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[1])
+end
+"""
+
+# ARGV - task id, lease expiration time
+# returns 0 if the task isn't leased anymore
+PROLONG_TASK_LEASE = """
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,70 +109,199 @@ class BotStorage():
     async def create(cls):
         self = BotStorage()
         self._redis = await StorageRedis.create(PREFIX)
+        await self._migrate_day_counts()
+        await self._migrate_bans()
         return self
 
     def __init__(self):
         self._redis: StorageRedis
 
-    async def get_bans(self) -> Dict[str, Any]:
-        return await self._redis.get_value('banned_users')
+    async def get_bans(self) -> Dict[str, str]:
+        return await self._redis.get_hash(BANS, {})
+
+    async def get_ban(self, user_id: Union[int, str]) -> Optional[str]:
+        """
+        Returns ban caption or None if user isn't banned
+        """
+        return await self._redis.get_hash_value(BANS, str(user_id))
+
+    async def add_ban(self, user_id: Union[int, str], caption: str):
+        async with self._redis.batch() as batch:
+            batch.set_hash_value(BANS, str(user_id), caption)
+
+        await self._redis.publish(BANS_CHANNEL, str(user_id))
+
+    async def delete_ban(self, user_id: Union[int, str]):
+        async with self._redis.batch() as batch:
+            batch.delete_hash_field(BANS, str(user_id))
 
-    async def set_bans(self, bans: dict):
-        await self._redis.set_value('banned_users', bans)
+        await self._redis.publish(BANS_CHANNEL, str(user_id))
+
+    async def subscribe_to_bans_changes(self) -> Channel:
+        return await self._redis.subscribe(BANS_CHANNEL)
+
+    async def _migrate_bans(self):
+        """
+        Move bans from the json blob saved by previous versions to the hash
+        """
+        async with self._redis.batch() as batch:
+            bans = batch.get_value('banned_users', None)
+            batch.delete('banned_users')
+
+        if not bans.result():
+            return
+
+        logger.info(f'Переносим баны: {bans.result()}')
+
+        async with self._redis.batch() as batch:
+            for user_id, caption in bans.result().items():
+                batch.set_hash_value(BANS, user_id, caption)
 
     async def get_appeals_count(self) -> int:
         count = await self._redis.get_value('appeals_sent_count', 0)
         return int(count)
 
     async def get_appeals_today_count(self) -> int:
-        return await self._redis.get_value('appeals_sent_today_count', 0)
+        return await self.get_appeals_day_count()
 
     async def get_appeals_yesterday_count(self) -> int:
-        return await self._redis.get_value('appeals_sent_yesterday_count', 0)
+        return await self.get_appeals_day_count(shift_days=-1)
+
+    async def get_appeals_day_count(self, shift_days=0) -> int:
+        day_key = self._day_count_key(get_today(shift_days))
+        count = await self._redis.get_value(day_key, 0)
+        return int(count)
 
     async def update_appeals_count(self, amount=1):
-        await self._update_whole_count(amount)
-        await self._update_today_count(amount)
+        day_key = self._day_count_key(get_today())
 
-    async def _update_whole_count(self, amount: int):
-        count = await self._redis.get_value('appeals_sent_count', 0)
-        await self._redis.set_value('appeals_sent_count', int(count) + amount)
+        async with self._redis.batch() as batch:
+            batch.increment('appeals_sent_count', amount)
+            batch.increment(day_key, amount)
+            batch.expire(day_key, DAY_COUNT_TTL)
 
-    async def _update_today_count(self, amount: int):
-        count = await self._redis.get_value('appeals_sent_today_count', None)
-        date = await self._redis.get_value('appeals_sent_today_date', None)
-        today = get_today()
+    def _day_count_key(self, date: str) -> str:
+        return f'appeals_sent_on:{date}'
 
-        if count is None or date is None:
-            await self._save_yesterday(0)
-            await self._redis.set_value('appeals_sent_today_count', amount)
-            await self._redis.set_value('appeals_sent_today_date', today)
-            return
+    async def _migrate_day_counts(self):
+        """
+        Move daily counters from the old today/yesterday keys to the per-day
+        keys. Old keys are read and deleted in one transaction so only one
+        bot process migrates them.
+        """
+        async with self._redis.batch() as batch:
+            count = batch.get_value('appeals_sent_today_count', None)
+            date = batch.get_value('appeals_sent_today_date', None)
+            yesterday_count = batch.get_value('appeals_sent_yesterday_count',
+                                              None)
+
+            batch.delete('appeals_sent_today_count',
+                         'appeals_sent_today_date',
+                         'appeals_sent_yesterday_count')
 
-        if today != date:
-            await self._save_yesterday(count)
-            await self._redis.set_value('appeals_sent_today_count', amount)
-            await self._redis.set_value('appeals_sent_today_date', today)
+        if date.result() is None:
             return
 
-        await self._redis.set_value('appeals_sent_today_count',
-                                    int(count) + amount)
+        today = date.result()
+        yesterday = date_cls.fromisoformat(today) - timedelta(days=1)
+        counts = {today: count.result(),
+                  yesterday.isoformat(): yesterday_count.result()}
+
+        logger.info(f'Переносим дневные счетчики обращений: {counts}')
+
+        async with self._redis.batch() as batch:
+            for day, day_count in counts.items():
+                if day_count:
+                    batch.increment(self._day_count_key(day), int(day_count))
+                    batch.expire(self._day_count_key(day), DAY_COUNT_TTL)
+
+    async def add_scheduled_task(self,
+                                 task_id: str,
+                                 task: dict,
+                                 execute_at: float):
+        """
+        Task with the same id replaces previous one both in the queue and
+        in payloads.
+        """
+        async with self._redis.batch() as batch:
+            batch.set_hash_value(TASKS_PAYLOADS, task_id, task)
+            batch.delete_hash_field(TASKS_ATTEMPTS, task_id)
+            batch.add_sorted_set_member(TASKS_QUEUE, task_id, execute_at)
+
+    async def claim_due_tasks(self,
+                              current_time: float,
+                              limit: int,
+                              lease_timeout: float,
+                              max_attempts: int) -> List[Tuple[str, dict]]:
+        """
+        Due tasks are leased until acknowledged. Tasks with expired lease
+        return to the queue.
+        """
+        raw_tasks = await self._redis.run_script(
+            CLAIM_DUE_TASKS,
+            TASKS_KEYS,
+            [current_time, limit, current_time + lease_timeout, max_attempts],
+            default=[])
+
+        tasks = []
+
+        for raw_id, raw_task in zip(raw_tasks[::2], raw_tasks[1::2]):
+            tasks.append((raw_id.decode('utf8'), decode_value(raw_task, {})))
+
+        return tasks
+
+    async def acknowledge_task(self, task_id: str):
+        await self._redis.run_script(ACKNOWLEDGE_TASK, TASKS_KEYS, [task_id])
+
+    async def prolong_task_lease(self,
+                                 task_id: str,
+                                 lease_expiration: float) -> bool:
+        prolonged = await self._redis.run_script(
+            PROLONG_TASK_LEASE,
+            TASKS_KEYS,
+            [task_id, lease_expiration],
+            default=1)
+
+        return bool(prolonged)
+
+    async def retry_task(self,
+                         task_id: str,
+                         execute_at: float,
+                         max_attempts: int) -> bool:
+        retried = await self._redis.run_script(
+            RETRY_TASK,
+            TASKS_KEYS,
+            [task_id, execute_at, max_attempts])
+
+        return bool(retried)
+
+    async def get_next_task_time(self) -> Optional[float]:
+        async with self._redis.batch() as batch:
+            next_due = batch.get_lowest_score(TASKS_QUEUE)
+            next_lease_expiration = batch.get_lowest_score(TASKS_PROCESSING)
 
-    async def _save_yesterday(self, amount: int):
-        await self._redis.set_value('appeals_sent_yesterday_count', amount)
+        times = [next_due.result(), next_lease_expiration.result()]
+        times = [time for time in times if time is not None]
+        return min(times, default=None)
 
-    @asynccontextmanager
-    async def tasks(self):
-        async with semaphore:
-            tasks = await self.get_scheduled_tasks()
+    async def get_tasks_queue_info(self) -> Tuple[int, int, Optional[float]]:
+        """
+        Returns queued tasks amount, leased tasks amount and the earliest
+        execution time in the queue
+        """
+        async with self._redis.batch() as batch:
+            queue_size = batch.count_sorted_set(TASKS_QUEUE)
+            leased = batch.count_sorted_set(TASKS_PROCESSING)
+            next_due = batch.get_lowest_score(TASKS_QUEUE)
 
-            try:
-                yield tasks
-            finally:
-                await self.set_scheduled_tasks(tasks)
+        return queue_size.result(), leased.result(), next_due.result()
 
-    async def get_scheduled_tasks(self) -> Dict[str, list]:
-        return await self._redis.get_value('scheduled_tasks')
+    async def pop_legacy_scheduled_tasks(self) -> Dict[str, list]:
+        """
+        Tasks saved by previous versions as a single json blob
+        """
+        async with self._redis.batch() as batch:
+            tasks = batch.get_value('scheduled_tasks')
+            batch.delete('scheduled_tasks')
 
-    async def set_scheduled_tasks(self, tasks: Dict[str, list]):
-        await self._redis.set_value('scheduled_tasks', tasks)
+        return tasks.result()
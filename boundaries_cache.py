@@ -0,0 +1,69 @@
+import gzip
+import json
+import logging
+import os
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+# cache written in another format is ignored
+CACHE_VERSION = 2
+
+
+class BoundariesCache:
+    """
+    Region boundaries saved on disk, so they are available right after
+    start without network.
+
+    Every region entry keeps the simplified boundary, download time and
+    validators (etag, last modified) of the response it came with.
+    """
+    def __init__(self, path: str, tolerance: float):
+        self._path = path
+        self._tolerance = tolerance
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with gzip.open(self._path, 'rt', encoding='utf8') as cache_file:
+                cache = json.load(cache_file)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            logger.exception('Не удалось прочитать кэш границ регионов')
+            return {}
+
+        if cache.get('version') != CACHE_VERSION or \
+                cache.get('tolerance') != self._tolerance:
+            logger.info('Кэш границ регионов устарел')
+            return {}
+
+        return cache['regions']
+
+    def update(self, region: str, entry: Dict[str, Any]):
+        """
+        Merges the entry into the cached one, so boundaries don't have to
+        be kept in memory to rewrite the file. Entry without boundary only
+        refreshes the cached boundary.
+        """
+        regions = self.load()
+        entry = {**regions.get(region, {}), **entry}
+
+        if 'boundary' not in entry:
+            return
+
+        regions[region] = entry
+        self.save(regions)
+
+    def save(self, regions: Dict[str, Dict[str, Any]]):
+        os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+        temp_path = self._path + '.tmp'
+        cache = {
+            'version': CACHE_VERSION,
+            'tolerance': self._tolerance,
+            'regions': regions,
+        }
+
+        with gzip.open(temp_path, 'wt', encoding='utf8') as cache_file:
+            json.dump(cache, cache_file)
+
+        os.replace(temp_path, self._path)
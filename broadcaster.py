@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+from uuid import uuid4
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import (ChatNotFound, MessageNotModified,
+                                      RetryAfter, Unauthorized)
+
+import config
+import users
+from locales import Locales
+from rate_limiter import TokenBucket
+from storage_redis import StorageRedis
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'broadcast:'
+CURRENT = 'current'
+LOCK = 'lock'
+
+# broadcast is taken over by another bot process if the lock isn't
+# prolonged in this time (seconds)
+LOCK_TIMEOUT = 120
+
+# min pause between progress message updates (seconds)
+PROGRESS_UPDATE_PAUSE = 5
+
+# broadcast interrupted by an error is continued from the last saved page
+# after a pause (seconds), until it fails this many times in a row
+RETRY_PAUSE = 10
+MAX_FAILURES = 5
+
+# KEYS - lock, ARGV - owner
+# expired lock could be taken by another process already, so the lock is
+# deleted only by its owner
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+
+return 0
+"""
+
+# KEYS - lock, current broadcast, ARGV - owner, lock timeout, progress
+# returns 0 if the lock is lost and progress isn't saved
+SAVE_PROGRESS = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SET', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+class Broadcaster:
+    """
+    Sends copies of a message to every user respecting telegram limits.
+    Progress is saved after every page of users, so an interrupted
+    broadcast continues after restart.
+    """
+    @classmethod
+    async def create(cls, bot: Bot, locales: Locales):
+        self = Broadcaster(bot, locales)
+        self._storage = await StorageRedis.create(PREFIX)
+        return self
+
+    def __init__(self, bot: Bot, locales: Locales):
+        self._bot = bot
+        self._locales = locales
+        self._storage: StorageRedis
+        self._owner = uuid4().hex
+        self._senders = asyncio.Semaphore(config.BROADCAST_SENDERS)
+
+        self._limiter = TokenBucket(config.BROADCAST_RATE,
+                                    config.BROADCAST_RATE)
+
+    async def start(self, message: types.Message, language: str) -> bool:
+        text = self._locales.text(language, 'broadcast_progress').format(0, 0)
+        progress_message = await self._bot.send_message(message.chat.id, text)
+
+        progress = {
+            'from_chat_id': message.chat.id,
+            'message_id': message.message_id,
+            'progress_message_id': progress_message.message_id,
+            'language': language,
+            'cursor': 0,
+            'delivered': 0,
+            'failed': 0,
+        }
+
+        # no expiration, broadcast is kept until finished
+        if not await self._storage.add_value(CURRENT,
+                                             progress,
+                                             0,
+                                             default=False):
+            text = self._locales.text(language, 'broadcast_in_progress')
+
+            await self._bot.edit_message_text(text,
+                                              message.chat.id,
+                                              progress_message.message_id)
+            return False
+
+        asyncio.ensure_future(self._run(progress))
+        return True
+
+    async def resume(self):
+        progress: Optional[dict] = await self._storage.get_value(CURRENT, None)
+
+        if progress:
+            logger.info(f'Продолжаем рассылку с курсора {progress["cursor"]}')
+            await self._run(progress)
+
+    async def _run(self, progress: dict):
+        if not await self._storage.add_value(LOCK, self._owner, LOCK_TIMEOUT):
+            logger.info('Рассылкой занимается другой процесс')
+            return
+
+        try:
+            await self._retry_sending(progress)
+        finally:
+            await self._storage.run_script(RELEASE_LOCK,
+                                           [LOCK],
+                                           [json.dumps(self._owner)])
+
+    async def _retry_sending(self, progress: dict):
+        for failures in range(1, MAX_FAILURES + 1):
+            try:
+                await self._send_to_everyone(progress)
+                return
+            except Exception:
+                logger.exception('Рассылка прервалась')
+
+            if failures < MAX_FAILURES:
+                await asyncio.sleep(RETRY_PAUSE)
+
+        logger.error(f'Рассылка отменена после ошибок: {progress}')
+        await self._storage.delete(CURRENT)
+        await self._show_progress(progress, 'broadcast_failed')
+
+    async def _send_to_everyone(self, progress: dict):
+        updated_at = time.monotonic()
+
+        async for cursor, user_ids in users.id_pages(
+                page_size=config.BROADCAST_PAGE_SIZE,
+                cursor=progress['cursor']):
+            results = await asyncio.gather(
+                *map(lambda user_id: self._send(progress, user_id), user_ids)
+            )
+
+            progress['delivered'] += results.count(True)
+            progress['failed'] += results.count(False)
+            progress['cursor'] = cursor
+
+            # zero cursor means there are no more users
+            if not cursor:
+                await self._storage.delete(CURRENT)
+                break
+
+            # redis errors aren't the lock loss, sending goes on
+            saved = await self._storage.run_script(
+                SAVE_PROGRESS,
+                [LOCK, CURRENT],
+                [json.dumps(self._owner), LOCK_TIMEOUT, json.dumps(progress)],
+                default=1)
+
+            if not saved:
+                logger.warning('Рассылку продолжает другой процесс')
+                return
+
+            if time.monotonic() - updated_at > PROGRESS_UPDATE_PAUSE:
+                await self._show_progress(progress, 'broadcast_progress')
+                updated_at = time.monotonic()
+
+        logger.info(f'Рассылка завершена: {progress}')
+        await self._show_progress(progress, 'broadcast_finished')
+
+    async def _send(self, progress: dict, user_id: int) -> bool:
+        async with self._senders:
+            while True:
+                await self._limiter.acquire()
+
+                try:
+                    await self._bot.copy_message(user_id,
+                                                 progress['from_chat_id'],
+                                                 progress['message_id'],
+                                                 disable_notification=True)
+                    return True
+                except RetryAfter as exc:
+                    logger.warning(f'Слишком часто шлем, пауза {exc.timeout}')
+                    self._limiter.pause(exc.timeout)
+                except (Unauthorized, ChatNotFound):
+                    # blocked by user, deactivated, bot, etc
+                    return False
+                except Exception:
+                    logger.exception("Ошибка при отправке всем пользователям")
+                    return False
+
+    async def _show_progress(self, progress: dict, text_id: str):
+        text = self._locales.text(progress['language'], text_id).format(
+            progress['delivered'],
+            progress['failed'])
+
+        try:
+            await self._bot.edit_message_text(text,
+                                              progress['from_chat_id'],
+                                              progress['progress_message_id'])
+        except MessageNotModified:
+            pass
+        except Exception:
+            logger.exception('Не удалось показать прогресс рассылки')
@@ -23,9 +23,11 @@ LANGUAGES = [BY, RU]
 # bot config
 PREVIOUS_ADDRESS_PREFIX = '/saved_'
 PREVIOUS_ADDRESS_REGEX = r'\/saved_\d+'
-APPEAL_STORAGE_LIMIT = 3
 TEMP_FILES_PATH = '/tmp/temp_files_parkun'
 
+# how long to keep composed appeals waiting for sending (seconds)
+APPEAL_STORAGE_TTL = 60 * 60 * 24 * 3
+
 # regionalization
 MINSK = 'minsk'
 
@@ -83,10 +85,42 @@ OSM_REGIONS = {
     MAHILEU_REGION: 'Mahilyow Region, Belarus',
 }
 
+# downloaded boundaries are kept here between restarts
+BOUNDARIES_CACHE_PATH = getenv("BOUNDARIES_CACHE_PATH",
+                               "./cache/boundaries.json.gz")
+
+# boundary points closer than this to their simplified outline are dropped
+# (in degrees, about 10 meters)
+BOUNDARIES_SIMPLIFY_TOLERANCE = 0.0001
+
+# older boundaries are downloaded again (in seconds)
+BOUNDARIES_MAX_AGE = 60 * 60 * 24 * 7
+
+# how often to check boundaries age (in seconds)
+BOUNDARIES_REFRESH_INTERVAL = 60 * 60 * 24
+
 # redis
 REDIS_HOST = getenv("REDIS_HOST", "localhost")
 REDIS_PORT = getenv("REDIS_PORT", "16379")
 REDIS_PASSWORD = getenv("REDIS_PASSWORD", "redis")
+REDIS_POOL_MIN_SIZE = int(getenv("REDIS_POOL_MIN_SIZE", "2"))
+REDIS_POOL_MAX_SIZE = int(getenv("REDIS_POOL_MAX_SIZE", "20"))
+
+# how often to ping redis pool connections (in seconds)
+REDIS_HEALTH_CHECK_INTERVAL = int(getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+# how many keys redis should check per one SCAN call
+REDIS_SCAN_BATCH_SIZE = 500
+
+# outgoing http connections
+HTTP_POOL_LIMIT = int(getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+
+# in seconds
+HTTP_KEEPALIVE_TIMEOUT = 30
+HTTP_DNS_CACHE_TTL = 300
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_TOTAL_TIMEOUT = 60
 
 # bot owner's telegram id to receive feedback
 ADMIN_ID = int(getenv("ADMIN_ID", "00000000"))
@@ -122,9 +156,6 @@ RABBIT_AMQP_PORT = getenv("RABBIT_AMQP_PORT", "5672")
 RABBIT_LOGIN = getenv("RABBIT_LOGIN", "parkun_bot")
 RABBIT_PASSWORD = getenv("RABBIT_PASSWORD", "parkun_bot")
 
-RABBIT_HTTP_ADDRESS = \
-    f'http://{RABBIT_LOGIN}:{RABBIT_PASSWORD}@{RABBIT_HOST}:{RABBIT_HTTP_PORT}'
-
 RABBIT_AMQP_ADDRESS = \
     f'amqp://{RABBIT_LOGIN}:{RABBIT_PASSWORD}@{RABBIT_HOST}:{RABBIT_AMQP_PORT}'
 
@@ -136,6 +167,9 @@ RABBIT_ROUTING_APPEAL_TO_QUEUE = 'appeal_to_queue'
 RABBIT_QUEUE_STATUS = 'status_to_bot'
 RABBIT_QUEUE_APPEALS = 'appeal'
 
+# messages to rabbit are kept here until published
+RABBIT_OUTBOX_PATH = getenv("RABBIT_OUTBOX_PATH", "./outbox/rabbit.jsonl")
+
 # sender messages types
 CAPTCHA_TEXT = 'captcha_text'
 CAPTCHA_URL = 'captcha_url'
@@ -175,6 +209,11 @@ NUMBERPLATES_RECOGNIZER_ENABLED = True
 NUMBERPLATES_RECOGNIZER_URL = getenv("NUMBERPLATES_RECOGNIZER_URL",
                                      "http://localhost:5001/recognize")
 
+# broadcasting to users (telegram allows about 30 messages per second)
+BROADCAST_RATE = 25
+BROADCAST_SENDERS = 10
+BROADCAST_PAGE_SIZE = 100
+
 # how many previos addresses should we save
 ADDRESS_AMOUNT_TO_SAVE = 5
 
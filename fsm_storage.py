@@ -0,0 +1,262 @@
+import copy
+import json
+import typing
+
+import aioredis
+from aiogram import Dispatcher
+from aiogram.contrib.fsm_storage.redis import STATE_DATA_KEY, RedisStorage2
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import FSMContextProxy
+
+import redis_pool
+import users
+
+# KEYS - legacy data, user data, USERS_INDEX, VERIFIED_INDEX
+# ARGV - legacy data as read, data ttl, user id, verified flag, then
+# encoded fields and values
+# legacy data is moved only if it's unchanged since read and nothing has
+# written the hash yet, returns 0 if the hash should be read instead
+MIGRATE_LEGACY_DATA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+
+redis.call('DEL', KEYS[1])
+
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+
+if #ARGV > 4 then
+    redis.call('HMSET', KEYS[2], unpack(ARGV, 5))
+
+    if tonumber(ARGV[2]) > 0 then
+        redis.call('EXPIRE', KEYS[2], ARGV[2])
+    end
+
+    redis.call('SADD', KEYS[3], ARGV[3])
+
+    if ARGV[4] == '1' then
+        redis.call('SADD', KEYS[4], ARGV[3])
+    else
+        redis.call('SREM', KEYS[4], ARGV[3])
+    end
+end
+
+return 1
+"""
+
+
+class IndexedRedisStorage(RedisStorage2):
+    """
+    FSM storage which borrows connections from the shared redis pool and
+    keeps users index up to date on every data change.
+
+    User data is a hash with a json encoded value in every field, so a
+    single field could be read or written without the rest of the data.
+    """
+    async def redis(self) -> aioredis.Redis:
+        return await redis_pool.get()
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        chat, user = self.check_address(chat=chat, user=user)
+        redis = await self.redis()
+
+        raw_fields = await redis.hgetall(users.data_key(user, chat),
+                                         encoding='utf8')
+
+        if raw_fields:
+            return users.decode_fields(raw_fields)
+
+        return await self._migrate_legacy_data(chat, user) or default or {}
+
+    async def get_fields(self, *fields: str,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None) -> dict:
+        """
+        Reads only listed fields, missing fields are omitted
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        redis = await self.redis()
+
+        key = users.data_key(user, chat)
+        pipeline = redis.pipeline()
+        pipeline.hmget(key, *fields, encoding='utf8')
+        pipeline.exists(key)
+        values, exists = await pipeline.execute()
+
+        # only data of previous versions could be elsewhere
+        if not exists:
+            data = await self._migrate_legacy_data(chat, user)
+            return {field: data[field] for field in fields if field in data}
+
+        return users.decode_fields(dict(zip(fields, values)))
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = users.data_key(user, chat)
+        redis = await self.redis()
+        transaction = redis.multi_exec()
+        transaction.delete(key, self.generate_key(chat, user, STATE_DATA_KEY))
+
+        if data:
+            transaction.hmset_dict(key, users.encode_fields(data))
+            self._expire(transaction, key)
+            users.index_user(transaction, user, data)
+        else:
+            users.unindex_user(transaction, user)
+
+        await transaction.execute()
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        if data is None:
+            data = {}
+
+        data.update(kwargs)
+        await self.update_fields(chat=chat, user=user, changed=data)
+
+    async def update_fields(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            changed: typing.Dict = None,
+                            removed: typing.Iterable[str] = (),
+                            data: typing.Optional[typing.Dict] = None):
+        """
+        Writes changed fields and deletes removed ones. Full data is needed
+        to notice that nothing is left, it's read from redis if not passed.
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        key = users.data_key(user, chat)
+        removed = list(removed)
+
+        if data is None:
+            data = await self.get_data(chat=chat, user=user)
+            data.update(changed or {})
+
+            for field in removed:
+                data.pop(field, None)
+
+        redis = await self.redis()
+        transaction = redis.multi_exec()
+
+        if changed:
+            transaction.hmset_dict(key, users.encode_fields(changed))
+
+        if removed:
+            transaction.hdel(key, *removed)
+
+        if data:
+            self._expire(transaction, key)
+            users.index_changed_fields(transaction,
+                                       user,
+                                       changed or {},
+                                       removed)
+        else:
+            # other writers could have added fields since data was read
+            users.unindex_user_if_empty(transaction, user, key)
+
+        await transaction.execute()
+
+    def _expire(self, redis: aioredis.Redis, key: str):
+        if self._data_ttl:
+            redis.expire(key, self._data_ttl)
+
+    async def _migrate_legacy_data(self,
+                                   chat: typing.Union[str, int],
+                                   user: typing.Union[str, int]) -> dict:
+        """
+        Data saved by previous versions as a single json blob is moved to
+        the hash on the first read
+        """
+        legacy_key = self.generate_key(chat, user, STATE_DATA_KEY)
+        key = users.data_key(user, chat)
+        redis = await self.redis()
+        raw_data = await redis.get(legacy_key, encoding='utf8')
+
+        if not raw_data:
+            return {}
+
+        data = json.loads(raw_data)
+        fields = []
+
+        for field, raw_value in users.encode_fields(data).items():
+            fields += [field, raw_value]
+
+        verified = '1' if data.get('verified', False) else ''
+
+        migrated = await redis.eval(
+            MIGRATE_LEGACY_DATA,
+            keys=[legacy_key, key, users.USERS_INDEX, users.VERIFIED_INDEX],
+            args=[raw_data, self._data_ttl or 0, user, verified, *fields])
+
+        if migrated:
+            return data
+
+        # migrated by another handler meanwhile
+        raw_fields = await redis.hgetall(key, encoding='utf8')
+        return users.decode_fields(raw_fields)
+
+
+class FieldsFSMContextProxy(FSMContextProxy):
+    """
+    Saves only changed and removed fields instead of the whole data
+    """
+    async def save(self, force=False):
+        self._check_closed()
+
+        changed = {}
+
+        for field, value in self._data.items():
+            if force or field not in self._copy or self._copy[field] != value:
+                changed[field] = value
+
+        removed = [field for field in self._copy if field not in self._data]
+
+        if changed or removed:
+            await self.fsm_context.storage.update_fields(
+                chat=self.fsm_context.chat,
+                user=self.fsm_context.user,
+                changed=changed,
+                removed=removed,
+                data=self._data)
+
+        if self._is_dirty or force:
+            await self.fsm_context.set_state(self.state)
+
+        self._is_dirty = False
+        self._copy = copy.deepcopy(self._data)
+
+
+class FieldsFSMContext(FSMContext):
+    def proxy(self) -> FieldsFSMContextProxy:
+        return FieldsFSMContextProxy(self)
+
+    async def get_fields(self, *fields: str) -> dict:
+        return await self.storage.get_fields(*fields,
+                                             chat=self.chat,
+                                             user=self.user)
+
+
+class FieldsDispatcher(Dispatcher):
+    """
+    Dispatcher giving handlers FSM context with field level access
+    """
+    def current_state(self, *,
+                      chat: typing.Union[str, int, None] = None,
+                      user: typing.Union[str, int, None] = None) \
+            -> FieldsFSMContext:
+        state = super().current_state(chat=chat, user=user)
+
+        return FieldsFSMContext(storage=self.storage,
+                                chat=state.chat,
+                                user=state.user)
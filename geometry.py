@@ -0,0 +1,235 @@
+import math
+from array import array
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:  # checks are done in pure python then
+    numpy = None
+
+# polygon edges are spread over this amount of vertical strips
+STRIPS_AMOUNT = 64
+
+# strips with fewer edges are checked in pure python even with numpy,
+# array operations don't pay off on them
+MIN_VECTORIZED_EDGES = 16
+
+Edge = Tuple[float, float, float, float]
+
+
+class Polygon:
+    """
+    Polygon ring prepared for fast point in polygon checks. Points out of
+    the bounding box are rejected at once, for the rest only edges of the
+    vertical strip containing the point are checked.
+    """
+    def __init__(self,
+                 ring: Sequence[Sequence[float]],
+                 strips_amount: int = STRIPS_AMOUNT):
+        longitudes = [point[0] for point in ring]
+        latitudes = [point[1] for point in ring]
+
+        self.min_longitude = min(longitudes)
+        self.max_longitude = max(longitudes)
+        self.min_latitude = min(latitudes)
+        self.max_latitude = max(latitudes)
+
+        self._strips_amount = strips_amount
+        self._strip_width = \
+            (self.max_longitude - self.min_longitude) / strips_amount
+
+        # edges of every strip packed as x1, y1, x2, y2, x1, y1...
+        self._strips: List[array] = \
+            [array('d') for _ in range(strips_amount)]
+
+        for edge in _edges(ring):
+            first = self._strip(min(edge[0], edge[2]))
+            last = self._strip(max(edge[0], edge[2]))
+
+            for strip in range(first, last + 1):
+                self._strips[strip].extend(edge)
+
+        # every strip as contiguous x1, y1, x2, y2 arrays
+        self._arrays: Optional[list] = None
+
+        if numpy is not None:
+            self._arrays = list(map(_to_arrays, self._strips))
+
+    def contains(self, longitude: float, latitude: float) -> bool:
+        if not (self.min_longitude <= longitude <= self.max_longitude and
+                self.min_latitude <= latitude <= self.max_latitude):
+            return False
+
+        strip = self._strip(longitude)
+
+        if self._arrays is not None and \
+                len(self._strips[strip]) >= MIN_VECTORIZED_EDGES * 4:
+            x1, y1, x2, y2 = self._arrays[strip]
+            crossings = _crossings(x1, y1, x2, y2, longitude, latitude)
+            return bool(numpy.count_nonzero(crossings) % 2)
+
+        # count crossings of the ray going from the point to the north
+        overlap = False
+
+        edges = self._strips[strip]
+
+        for x1, y1, x2, y2 in zip(*[iter(edges)] * 4):
+            if ((x1 > longitude) != (x2 > longitude) and
+                    latitude < (y2 - y1) * (longitude - x1) / (x2 - x1) + y1):
+                overlap = not overlap
+
+        return overlap
+
+    def contains_many(self,
+                      longitudes: Sequence[float],
+                      latitudes: Sequence[float]) -> List[bool]:
+        """
+        Checks many points at once, points of one strip are checked by
+        one array operation if numpy is available
+        """
+        if self._arrays is None:
+            return list(map(self.contains, longitudes, latitudes))
+
+        longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        result = numpy.zeros(len(longitudes), dtype=bool)
+
+        in_box = numpy.flatnonzero(
+            (longitudes >= self.min_longitude) &
+            (longitudes <= self.max_longitude) &
+            (latitudes >= self.min_latitude) &
+            (latitudes <= self.max_latitude))
+
+        if self._strip_width:
+            # the same rounding as in _strip, floor division differs from
+            # it on strip borders
+            strips = numpy.floor(
+                (longitudes[in_box] - self.min_longitude) / self._strip_width)
+
+            strips = numpy.clip(strips, 0, self._strips_amount - 1)
+        else:
+            strips = numpy.zeros(len(in_box))
+
+        for strip in numpy.unique(strips):
+            points = in_box[strips == strip]
+            x1, y1, x2, y2 = self._arrays[int(strip)]
+
+            # points are rows, edges are columns
+            crossings = _crossings(x1, y1, x2, y2,
+                                   longitudes[points, None],
+                                   latitudes[points, None])
+
+            result[points] = numpy.count_nonzero(crossings, axis=1) % 2 == 1
+
+        return result.tolist()
+
+    def _strip(self, longitude: float) -> int:
+        if not self._strip_width:
+            return 0
+
+        strip = int((longitude - self.min_longitude) / self._strip_width)
+        return min(max(strip, 0), self._strips_amount - 1)
+
+
+def _edges(ring: Sequence[Sequence[float]]) -> Iterator[Edge]:
+    for i in range(len(ring)):
+        x1, y1 = ring[i - 1][0], ring[i - 1][1]
+        x2, y2 = ring[i][0], ring[i][1]
+
+        # vertical edges never cross the ray
+        if x1 != x2:
+            yield x1, y1, x2, y2
+
+
+def _to_arrays(edges: array) -> tuple:
+    table = numpy.frombuffer(edges, dtype=numpy.float64).reshape(-1, 4)
+    return tuple(numpy.ascontiguousarray(column) for column in table.T)
+
+
+def _crossings(x1, y1, x2, y2, longitude, latitude):
+    """
+    Which edges the ray going from the point to the north crosses
+    """
+    spans = (x1 > longitude) != (x2 > longitude)
+    edge_latitudes = (y2 - y1) * (longitude - x1) / (x2 - x1) + y1
+    return spans & (latitude < edge_latitudes)
+
+
+def rings(boundary: list) -> Iterator[list]:
+    """
+    Region could consist of several parts, every ring is returned
+    separately
+    """
+    if not boundary or not boundary[0]:
+        return
+
+    if isinstance(boundary[0][0], list):
+        for part in boundary:
+            yield from rings(part)
+    elif len(boundary) > 2:
+        yield boundary
+
+
+def simplify(ring: Sequence[Sequence[float]], tolerance: float) -> list:
+    """
+    Douglas-Peucker simplification, points closer than tolerance to the
+    line between kept neighbours are dropped
+    """
+    if tolerance <= 0 or len(ring) < 4:
+        return list(ring)
+
+    kept = [False] * len(ring)
+    kept[0] = kept[-1] = True
+    sections = [(0, len(ring) - 1)]
+
+    while sections:
+        first, last = sections.pop()
+        farthest, farthest_distance = 0, tolerance
+
+        for point in range(first + 1, last):
+            distance = _distance(ring[point], ring[first], ring[last])
+
+            if distance > farthest_distance:
+                farthest, farthest_distance = point, distance
+
+        if farthest:
+            kept[farthest] = True
+            sections.append((first, farthest))
+            sections.append((farthest, last))
+
+    simplified = [point for point, keep in zip(ring, kept) if keep]
+
+    # small rings would degenerate, they are cheap to keep as is
+    if len(simplified) < 4:
+        return list(ring)
+
+    return simplified
+
+
+def simplified(boundary: list, tolerance: float) -> list:
+    """
+    All rings of the boundary simplified
+    """
+    return [simplify(ring, tolerance) for ring in rings(boundary)]
+
+
+def _distance(point: Sequence[float],
+              start: Sequence[float],
+              end: Sequence[float]) -> float:
+    """
+    Distance from the point to the segment
+    """
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    length = dx * dx + dy * dy
+
+    if length:
+        projection = ((point[0] - start[0]) * dx +
+                      (point[1] - start[1]) * dy) / length
+
+        projection = min(max(projection, 0), 1)
+    else:
+        projection = 0
+
+    return math.hypot(point[0] - start[0] - projection * dx,
+                      point[1] - start[1] - projection * dy)
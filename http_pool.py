@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class HttpPool:
+    """
+    Process-wide http session. Every outgoing request reuses its kept alive
+    connections instead of opening new ones.
+    """
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> aiohttp.ClientSession:
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                self._session = self._connect()
+
+        return self._session
+
+    def _connect(self) -> aiohttp.ClientSession:
+        logger.info('Создаем пул http соединений')
+
+        connector = aiohttp.TCPConnector(
+            limit=config.HTTP_POOL_LIMIT,
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_TTL)
+
+        timeout = aiohttp.ClientTimeout(total=config.HTTP_TOTAL_TIMEOUT,
+                                        connect=config.HTTP_CONNECT_TIMEOUT)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+pool = HttpPool()
+
+
+async def get() -> aiohttp.ClientSession:
+    return await pool.get()
+
+
+async def close():
+    await pool.close()
@@ -0,0 +1,21 @@
+import asyncio
+from typing import Hashable
+from weakref import WeakValueDictionary
+
+
+class KeyedLocks:
+    """
+    Separate lock for every key. Lock is forgotten as soon as nobody holds
+    or waits for it, so the registry doesn't grow with the number of keys.
+    """
+    def __init__(self):
+        self._locks: WeakValueDictionary = WeakValueDictionary()
+
+    def get(self, key: Hashable) -> asyncio.Lock:
+        lock = self._locks.get(key)
+
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+
+        return lock
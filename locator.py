@@ -1,14 +1,19 @@
 import asyncio
 import json
 import logging
+import time
 from asyncio.events import AbstractEventLoop
-from typing import Generator, Optional
+from typing import Any, Dict, List, Optional, Sequence
 
 import aiohttp
 
 import config
 import datetime_parser
+import http_pool
 import territory
+from address_cache import AddressCache
+from boundaries_cache import BoundariesCache
+from geometry import Polygon, rings, simplified
 from scheduler import RELOAD_BOUNDARY, Scheduler
 
 logger = logging.getLogger(__name__)
@@ -20,11 +25,33 @@ Coordinates = tuple[float, float]
 
 class Locator:
     def __init__(self, loop: AbstractEventLoop):
-        self._boundaries = {}
+        self._boundaries: Dict[str, List[Polygon]] = {}
+        self._cache = BoundariesCache(config.BOUNDARIES_CACHE_PATH,
+                                      config.BOUNDARIES_SIMPLIFY_TOLERANCE)
+
+        # download time and validators of cached boundaries, boundaries
+        # themselves are only on disk
+        self._cached: Dict[str, Dict[str, Any]] = {}
+        self._cache_lock = asyncio.Lock()
         self.loop = loop
         self.scheduler: Scheduler
+        self.address_cache: AddressCache
         self.bot_id: int = 0
 
+    def load_cached_boundaries(self) -> None:
+        """
+        Boundaries from the previous run, region lookup works with them
+        until fresh ones are downloaded
+        """
+        for region, entry in self._cache.load().items():
+            boundary = entry.pop('boundary')
+
+            if region in config.OSM_REGIONS:
+                self._boundaries[region] = list(map(Polygon, rings(boundary)))
+                self._cached[region] = entry
+
+        logger.info(f"Границ регионов в кэше: {len(self._boundaries)}")
+
     async def get_boundary(self,
                            region: str,
                            try_counter=5) -> None:
@@ -38,14 +65,27 @@ class Locator:
         )
 
         try:
-            async with aiohttp.ClientSession() as http_session:
-                async with http_session.get(url,
-                                            params=params) as response:
-                    if response.status != 200:
-                        return None
+            http_session = await http_pool.get()
+
+            async with http_session.get(
+                    url,
+                    params=params,
+                    headers=self._cached_validators(region)) as response:
+                validators = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }
+
+                if response.status == 304:
+                    logger.info(f"Границы региона {region} не изменились")
+                    await self._cache_boundary(region, None, validators)
+                    return None
 
-                    resp_json = await response.json(content_type=None)
-                    boundary = resp_json[0]['geojson']['coordinates'][0]
+                if response.status != 200:
+                    return None
+
+                resp_json = await response.json(content_type=None)
+                boundary = resp_json[0]['geojson']['coordinates'][0]
 
         except aiohttp.ServerTimeoutError:
             boundary = []
@@ -72,11 +112,71 @@ class Locator:
             else:
                 logger.warning(f"Закончились попытки для региона {region}")
                 asyncio.ensure_future(self.download_boundary_later(region))
-                self._boundaries[region] = []
+
+                # boundary from the cache is better than nothing
+                self._boundaries.setdefault(region, [])
 
         else:
             logger.info(f"Загружены границы региона {region}")
-            self._boundaries[region] = boundary
+
+            # raw boundaries have far more points than lookup needs
+            boundary = await self.loop.run_in_executor(
+                None,
+                simplified,
+                boundary,
+                config.BOUNDARIES_SIMPLIFY_TOLERANCE)
+
+            self._boundaries[region] = list(map(Polygon, boundary))
+            await self._cache_boundary(region, boundary, validators)
+
+    def _cached_validators(self, region: str) -> Dict[str, str]:
+        """
+        Headers to ask for the boundary only if it has changed since it
+        was cached
+        """
+        entry = self._cached.get(region)
+        headers = {}
+
+        if entry is None:
+            return headers
+
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def _cache_is_fresh(self, region: str) -> bool:
+        entry = self._cached.get(region)
+
+        if entry is None or region not in self._boundaries:
+            return False
+
+        return time.time() - entry['fetched_at'] < config.BOUNDARIES_MAX_AGE
+
+    async def _cache_boundary(self,
+                              region: str,
+                              boundary: Optional[list],
+                              validators: Dict[str, Optional[str]]) -> None:
+        """
+        Boundary is None if the cached one hasn't changed
+        """
+        entry = {'fetched_at': time.time(), **validators}
+        self._cached[region] = entry
+
+        if boundary is not None:
+            entry = {**entry, 'boundary': boundary}
+
+        async with self._cache_lock:
+            try:
+                await self.loop.run_in_executor(None,
+                                                self._cache.update,
+                                                region,
+                                                entry)
+            except Exception:
+                logger.exception('Не удалось сохранить кэш границ регионов')
 
     async def download_boundary_later(self, region: str) -> None:
         task = {
@@ -92,48 +192,23 @@ class Locator:
         await self.scheduler.add_task(task)
 
     async def download_boundaries(self) -> None:
-        tasks = []
-
-        for region in config.OSM_REGIONS:
-            task = asyncio.ensure_future(self.get_boundary(region))
-            tasks.append(task)
-            await asyncio.sleep(1)
-
-        asyncio.gather(*tasks)
-
-    def __point_is_in_polygon(self, boundary: list[list],
-                              longitude: float,
-                              latitude: float) -> bool:
-        overlap = False
-        vertices_amount = len(boundary)
-        j = vertices_amount - 1
+        """
+        Downloads missing and outdated boundaries, then checks their age
+        from time to time. Fresh ones are taken from the cache.
+        """
+        while True:
+            tasks = []
 
-        for i in range(vertices_amount - 1):
-            if (((boundary[i][0] > longitude) !=
-                    (boundary[j][0] > longitude)) and
-                (latitude <
-                    (boundary[j][1] - boundary[i][1]) *
-                    (longitude - boundary[i][0]) /
-                    (boundary[j][0] - boundary[i][0]) + boundary[i][1])):
-                overlap = not overlap
+            for region in config.OSM_REGIONS:
+                if self._cache_is_fresh(region):
+                    continue
 
-            j = i
+                task = asyncio.ensure_future(self.get_boundary(region))
+                tasks.append(task)
+                await asyncio.sleep(1)
 
-        return overlap
-
-    def __areas_in_region(self, boundaries: list[list]) -> Generator:
-        """Если регион разбит на части, то будем возвращать каждую"""
-        try:
-            if isinstance(boundaries[0][0], list):
-                for boundary in boundaries:
-                    if isinstance(boundary[0][0], list):
-                        yield self.__areas_in_region(boundary)
-                    else:
-                        yield boundary
-            else:
-                yield boundaries
-        except IndexError:
-            yield []
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.sleep(config.BOUNDARIES_REFRESH_INTERVAL)
 
     async def get_region(self,
                          coordinates: Optional[Coordinates],
@@ -145,22 +220,57 @@ class Locator:
             if region not in self._boundaries:
                 continue
 
-            areas = self.__areas_in_region(self._boundaries[region])
-
-            for area in areas:
-                if self.__point_is_in_polygon(area,
-                                              coordinates[0],
-                                              coordinates[1]):
+            for area in self._boundaries[region]:
+                if area.contains(coordinates[0], coordinates[1]):
                     if territory.has_subregions(region):
                         return await self.get_region(coordinates, region)
                     else:
                         return region
 
+    def get_regions(self,
+                    coordinates: Sequence[Coordinates],
+                    region: str = None) -> List[Optional[str]]:
+        """
+        Same as get_region for many points at once, e.g. for backfills
+        """
+        found: List[Optional[str]] = [None] * len(coordinates)
+        unresolved = list(range(len(coordinates)))
+
+        for region in territory.regions(region):
+            inside = []
+
+            for area in self._boundaries.get(region, []):
+                if not unresolved:
+                    break
+
+                overlaps = area.contains_many(
+                    [coordinates[point][0] for point in unresolved],
+                    [coordinates[point][1] for point in unresolved])
+
+                inside += [point for point, overlap
+                           in zip(unresolved, overlaps) if overlap]
+
+                unresolved = [point for point, overlap
+                              in zip(unresolved, overlaps) if not overlap]
+
+            if not inside:
+                continue
+
+            if territory.has_subregions(region):
+                subregions = self.get_regions(
+                    [coordinates[point] for point in inside],
+                    region)
+            else:
+                subregions = [region] * len(inside)
+
+            for point, subregion in zip(inside, subregions):
+                found[point] = subregion
+
+        return found
+
     async def get_address(self,
                           coordinates: Coordinates,
                           language=config.RU) -> Optional[str]:
-        str_coordinates = f"{str(coordinates[0])}, {str(coordinates[1])}"
-
         if language == config.RU:
             lang = 'ru_RU'
         elif language == config.BY:
@@ -168,6 +278,27 @@ class Locator:
         else:
             lang = 'ru_RU'
 
+        cached, address = await self.address_cache.get(coordinates, lang)
+
+        if cached:
+            return address
+
+        try:
+            address = await self._request_address(coordinates, lang)
+        except Exception:
+            # failures are cached too, so an unavailable geocoder isn't
+            # waited for on every message
+            logger.exception("Ошибка при получении адреса")
+            address = None
+
+        await self.address_cache.set(coordinates, lang, address)
+        return address
+
+    async def _request_address(self,
+                               coordinates: Coordinates,
+                               lang: str) -> Optional[str]:
+        str_coordinates = f"{str(coordinates[0])}, {str(coordinates[1])}"
+
         params = (
             ('geocode', str_coordinates),
             ('kind', 'house'),
@@ -176,25 +307,26 @@ class Locator:
             ('lang', lang)
         )
 
-        async with aiohttp.ClientSession() as http_session:
-            async with http_session.get(config.BASE_YANDEX_MAPS_URL,
-                                        params=params) as response:
-                if response.status != 200:
-                    return None
+        http_session = await http_pool.get()
 
-                resp_json = await response.json(content_type=None)
-                address_array = resp_json['response']['GeoObjectCollection']
+        async with http_session.get(config.BASE_YANDEX_MAPS_URL,
+                                    params=params) as response:
+            if response.status != 200:
+                return None
 
-                try:
-                    address_bottom = \
-                        address_array['featureMember'][0]['GeoObject']
+            resp_json = await response.json(content_type=None)
+            address_array = resp_json['response']['GeoObjectCollection']
 
-                    address = address_bottom['name'] + ', ' +\
-                        address_bottom['description']
-                except IndexError:
-                    address = ADDRESS_FAIL
+            try:
+                address_bottom = \
+                    address_array['featureMember'][0]['GeoObject']
 
-                return address
+                address = address_bottom['name'] + ', ' +\
+                    address_bottom['description']
+            except IndexError:
+                address = ADDRESS_FAIL
+
+            return address
 
     async def get_coordinates(self, address: str) -> Optional[Coordinates]:
         params = (
@@ -204,25 +336,26 @@ class Locator:
             ('format', 'json'),
         )
 
-        async with aiohttp.ClientSession() as http_session:
-            async with http_session.get(config.BASE_YANDEX_MAPS_URL,
-                                        params=params) as response:
-                if response.status != 200:
-                    return None
+        http_session = await http_pool.get()
 
-                resp_json = await response.json(content_type=None)
-                address_array = resp_json['response']['GeoObjectCollection']
+        async with http_session.get(config.BASE_YANDEX_MAPS_URL,
+                                    params=params) as response:
+            if response.status != 200:
+                return None
 
-                try:
-                    address_bottom = \
-                        address_array['featureMember'][0]['GeoObject']
+            resp_json = await response.json(content_type=None)
+            address_array = resp_json['response']['GeoObjectCollection']
 
-                    str_coordinates = address_bottom['Point']['pos']
-                    str_coordinates = str_coordinates.split(' ')
+            try:
+                address_bottom = \
+                    address_array['featureMember'][0]['GeoObject']
 
-                    coordinates = (float(str_coordinates[0]),
-                                   float(str_coordinates[1]))
-                except IndexError:
-                    return None
+                str_coordinates = address_bottom['Point']['pos']
+                str_coordinates = str_coordinates.split(' ')
+
+                coordinates = (float(str_coordinates[0]),
+                               float(str_coordinates[1]))
+            except IndexError:
+                return None
 
-                return coordinates
+            return coordinates
@@ -1,5 +1,5 @@
-import aiohttp
 import config
+import http_pool
 
 
 class MailVerifier:
@@ -9,7 +9,8 @@ class MailVerifier:
             ('language', language),
         )
 
-        async with aiohttp.ClientSession() as http_session:
-            async with http_session.get(config.MAIL_VERIFIER_URL,
-                                        params=params) as response:
-                return await response.text()
+        http_session = await http_pool.get()
+
+        async with http_session.get(config.MAIL_VERIFIER_URL,
+                                    params=params) as response:
+            return await response.text()
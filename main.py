@@ -10,32 +10,38 @@ from pathlib import Path
 from typing import Any, List, Optional, Tuple, Union
 
 from aiogram import Bot, types
-from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher import Dispatcher, FSMContext
 from aiogram.dispatcher.storage import FSMContextProxy
 from aiogram.types.photo_size import PhotoSize
 from aiogram.utils import executor
 from aiogram.utils.exceptions import BadRequest as AiogramBadRequest
-from aiogram.utils.exceptions import (CantTalkWithBots, ChatNotFound,
-                                      MessageNotModified)
+from aiogram.utils.exceptions import ChatNotFound, MessageNotModified
 from dateutil import tz
 from disposable_email_domains import blocklist
 
 import config
 import datetime_parser
+import http_pool
+import redis_pool
 import territory
-import users
+from address_cache import AddressCache
+from album_collector import AlbumCollector
+from appeal_storage import AppealStorage
 from appeal_summary import AppealSummary
 from appeal_text import AppealText
+from ban_list import BanList
 from bot_storage import BotStorage
+from broadcaster import Broadcaster
+from fsm_storage import FieldsDispatcher, IndexedRedisStorage
 from imap_email import Email
+from keyed_locks import KeyedLocks
 from locales import Locales
 from locator import ADDRESS_FAIL, Locator, Coordinates
 from mail_verifier import MailVerifier
 from photo_manager import PhotoManager
 from photoitem import PhotoItem
 from rabbit_amqp import Rabbit as AMQPRabbit
-from rabbit_http import Rabbit as HTTPRabbit
+from rabbit_publisher import Rabbit as RabbitPublisher
 from scheduler import CANCEL_ON_IDLE, RELOAD_BOUNDARY, Scheduler
 from states import Form
 from states_stack import StatesStack
@@ -67,22 +73,26 @@ logger = logging.getLogger("parkun_bot")
 loop = asyncio.get_event_loop()
 bot = Bot(token=config.API_TOKEN, loop=loop)
 
-storage = RedisStorage2(host=config.REDIS_HOST,
-                        port=config.REDIS_PORT,
-                        password=config.REDIS_PASSWORD)
+storage = IndexedRedisStorage(host=config.REDIS_HOST,
+                              port=config.REDIS_PORT,
+                              password=config.REDIS_PASSWORD)
 
-dp = Dispatcher(bot, storage=storage)
+dp = FieldsDispatcher(bot, storage=storage)
 mail_verifier = MailVerifier()
-semaphore = asyncio.Semaphore()
+user_locks = KeyedLocks()
+album_collector = AlbumCollector()
 locales = Locales()
 validator = Validator()
-rabbit_http = HTTPRabbit()
+rabbit_publisher = RabbitPublisher()
 rabbit_amqp = AMQPRabbit()
 photo_manager: PhotoManager
 bot_storage: BotStorage
+appeal_storage: AppealStorage
+ban_list: BanList
 statistic: Statistic
 scheduler: Scheduler
 locator: Locator
+broadcaster: Broadcaster
 
 
 def get_value(data: Union[FSMContextProxy, dict],
@@ -149,8 +159,9 @@ async def get_ui_lang(state=None,
     if data:
         return get_value(data, 'ui_lang')
     elif state:
-        async with state.proxy() as my_data:
-            return get_value(my_data, 'ui_lang')
+        # язык нужен почти везде, поэтому читаем только его
+        my_data = await state.get_fields('ui_lang')
+        return get_value(my_data, 'ui_lang')
 
     return config.RU
 
@@ -500,7 +511,7 @@ async def share_post(user_id: int,
         'reply_type': reply_type,
     }
 
-    await rabbit_http.send_sharing(data)
+    await rabbit_publisher.send_sharing(data)
 
 
 async def add_channel_post_to_success_police_response(language: str,
@@ -583,13 +594,13 @@ async def send_appeal(user_id: int, appeal_id: int) -> None:
 
     async with state.proxy() as data:
         delete_prepared_violation(data)
-        appeal = get_appeal_from_user_queue(data, appeal_id)
+        appeal = await get_appeal_from_user_queue(data, user_id, appeal_id)
 
         if not appeal:
             await parse_appeal_from_message(data, user_id, appeal_id)
             return
 
-        await rabbit_http.send_appeal(appeal, user_id)
+        await rabbit_publisher.send_appeal(appeal, user_id)
 
         language = await get_ui_lang(data=data)
         text = locales.text(language, 'appeal_sent')
@@ -637,7 +648,7 @@ async def process_entered_violation(data: FSMContextProxy,
         return
 
     appeal = await compose_appeal(data, user_id, appeal_id)
-    add_appeal_to_user_queue(data, appeal, appeal_id)
+    await add_appeal_to_user_queue(user_id, appeal, appeal_id)
     delete_prepared_violation(data)
 
 
@@ -836,7 +847,7 @@ async def send_captcha_text(state: FSMContext,
         appeal_email = await get_appeal_email(data, user_id)
 
     try:
-        await rabbit_http.send_captcha_text(
+        await rabbit_publisher.send_captcha_text(
             captcha_text,
             user_id,
             appeal_id,
@@ -860,29 +871,35 @@ def ensure_attachments_availability(data: FSMContextProxy):
         data['violation_photos_amount'] = 0
 
 
-async def violation_storage_full(state):
-    # потанцевально узкое место, все потоки всех пользователей будут ждать
-    # пока кто-то один проверяет, если я правильно понимаю
-    # нужно сделать каждому пользователю свой личный семафорчик, но я пока
-    # что не знаю как
-    async with semaphore, state.proxy() as data:
-        ensure_attachments_availability(data)
+def reserve_violation_photos(data: FSMContextProxy, amount: int) -> int:
+    """
+    Returns how many of the photos fit into the violation storage
+    """
+    ensure_attachments_availability(data)
 
-        violation_photos_amount = get_value(data, 'violation_photos_amount')
+    violation_photos_amount = get_value(data, 'violation_photos_amount')
+    free_places = config.MAX_VIOLATION_PHOTOS - violation_photos_amount
+    reserved = max(0, min(amount, free_places))
 
-        if violation_photos_amount < config.MAX_VIOLATION_PHOTOS:
-            data['violation_photos_amount'] += 1
-            return False
-        else:
-            return True
+    data['violation_photos_amount'] += reserved
+    return reserved
 
 
 async def add_photo_to_attachments(photo: PhotoSize,
                                    data: FSMContextProxy,
                                    user_id: int) -> None:
+    await add_photos_to_attachments([photo], data, user_id)
+
+
+async def add_photos_to_attachments(photos: List[PhotoSize],
+                                    data: FSMContextProxy,
+                                    user_id: int) -> None:
     ensure_attachments_availability(data)
-    data['violation_photo_ids'].append(photo['file_id'])
-    photo_manager.stash_photo(user_id, photo)
+
+    for photo in photos:
+        data['violation_photo_ids'].append(photo['file_id'])
+
+    photo_manager.stash_photos(user_id, photos)
 
 
 async def get_prepared_photos(data: FSMContextProxy,
@@ -950,7 +967,6 @@ def get_default_value(key):
         'ui_lang': config.BY,
         'recipient': config.MINSK,
         'violation_attachments': [],
-        'appeals': {},
         'violation_photo_ids': [],
         'violation_photo_files_paths': [],
         'violation_photos_amount': 0,
@@ -968,16 +984,10 @@ def get_default_value(key):
         return ''
 
 
-def add_appeal_to_user_queue(data: FSMContextProxy,
-                             appeal: dict,
-                             appeal_id: int) -> None:
-    appeals = get_value(data, 'appeals')
-    delete_old_appeals(appeals)
-
-    if not get_value(appeals, str(appeal_id), {}, read_only=True):
-        logger.info(f'Такого обращения еще нет в хранилище - {appeal_id}')
-        appeals[str(appeal_id)] = appeal
-        data['appeals'] = appeals
+async def add_appeal_to_user_queue(user_id: int,
+                                   appeal: dict,
+                                   appeal_id: int) -> None:
+    await appeal_storage.add(user_id, appeal_id, appeal)
 
 
 def get_original_appeal_id(message: types.Message,
@@ -989,39 +999,31 @@ def get_original_appeal_id(message: types.Message,
         return it_is_reply, message.message_id
 
 
-def get_appeal_from_user_queue(data: FSMContextProxy,
-                               appeal_id: int) -> dict:
-    appeals = get_value(data, 'appeals')
-    appeal = get_value(appeals, str(appeal_id), {}, read_only=True)
-    return appeal
+async def get_appeal_from_user_queue(data: FSMContextProxy,
+                                     user_id: int,
+                                     appeal_id: int) -> dict:
+    if appeal := await appeal_storage.get(user_id, appeal_id):
+        return appeal
+
+    # раньше обращения хранились в данных пользователя
+    return data.get('appeals', {}).get(str(appeal_id), {})
 
 
 async def delete_appeal_from_user_queue(data: FSMContextProxy,
                                         user_id: int,
                                         appeal_id: int,
                                         with_files=True) -> None:
-    appeals: dict = get_value(data, 'appeals')
-    appeals.pop(str(appeal_id), 'default_value')
-    data['appeals'] = appeals
+    await appeal_storage.delete(user_id, appeal_id)
 
-    # clear photos storage except files on disk
-    await photo_manager.clear_storage(user_id, appeal_id, with_files)
-
-
-def delete_old_appeals(appeals: dict,
-                       limit: int = config.APPEAL_STORAGE_LIMIT) -> dict:
-    keys = list(appeals.keys())
-    keys.sort(reverse=True)
-    keys_amount = len(keys)
-    logger.info(f'Длина хранилища обращений - {keys_amount}')
+    # раньше обращения хранились в данных пользователя
+    if 'appeals' in data:
+        data['appeals'].pop(str(appeal_id), None)
 
-    if keys_amount > limit:
-        keys_to_delete = keys[limit:]
+        if not data['appeals']:
+            data.pop('appeals')
 
-        for key in keys_to_delete:
-            appeals.pop(key)
-
-    return appeals
+    # clear photos storage except files on disk
+    await photo_manager.clear_storage(user_id, appeal_id, with_files)
 
 
 async def pop_saved_state(user_id: int, from_id: int):
@@ -1828,14 +1830,8 @@ async def get_social_data_from_post(
     return text, photo_pathes, photo_ids
 
 
-async def share_to_users(message: types.Message):
-    async for user_id in users.every_id():
-        try:
-            await message.send_copy(user_id, disable_notification=True)
-        except CantTalkWithBots:
-            pass
-        except Exception:
-            logger.exception("Ошибка при отправке всем пользователям")
+async def share_to_users(message: types.Message, language: str):
+    await broadcaster.start(message, language)
 
 
 async def show_settings(message: types.Message, state: FSMContext):
@@ -2266,14 +2262,13 @@ async def ask_to_enter_numberplates(user_id: int,
 
 
 async def user_banned(language: str, user_id: int) -> bool:
-    bans = await bot_storage.get_bans()
-    key = str(user_id)
+    caption = await ban_list.get_caption(user_id)
 
-    if key in bans:
-        logger.info(f'User id {key} found in bans {str(bans)}')
+    if caption is not None:
+        logger.info(f'User id {user_id} found in bans: {caption}')
 
         try:
-            text = locales.text(language, 'you_are_banned') + ' ' + bans[key]
+            text = locales.text(language, 'you_are_banned') + ' ' + caption
             await bot.send_message(user_id, text)
             return True
         except Exception:
@@ -3012,7 +3007,7 @@ async def cancel_captcha_input(call, state: FSMContext):
 
     async with state.proxy() as data:
 
-        await rabbit_http.send_cancel(
+        await rabbit_publisher.send_cancel(
             get_value(data, 'appeal_id'),
             call.message.chat.id,
             get_value(data, 'appeal_response_queue'))
@@ -3334,7 +3329,7 @@ async def banlist_user_command(message: types.Message):
     logger.info('Банлист - ' +
                 f'{str(message.from_user.id)}:{message.from_user.username}')
 
-    bans = await bot_storage.get_bans()
+    bans = await ban_list.get_all()
 
     await bot.send_message(message.chat.id,
                            json.dumps(bans,
@@ -3342,6 +3337,38 @@ async def banlist_user_command(message: types.Message):
                                       indent='    '))
 
 
+@dp.message_handler(commands=['scheduler'], state='*')
+async def scheduler_metrics_command(message: types.Message):
+    if message.chat.id != config.ADMIN_ID:
+        return
+
+    logger.info('Метрики шедулера - ' +
+                f'{str(message.from_user.id)}:{message.from_user.username}')
+
+    metrics = await scheduler.get_metrics()
+
+    await bot.send_message(message.chat.id,
+                           json.dumps(metrics,
+                                      ensure_ascii=False,
+                                      indent='    '))
+
+
+@dp.message_handler(commands=['geocoder'], state='*')
+async def geocoder_metrics_command(message: types.Message):
+    if message.chat.id != config.ADMIN_ID:
+        return
+
+    logger.info('Метрики кэша адресов - ' +
+                f'{str(message.from_user.id)}:{message.from_user.username}')
+
+    metrics = locator.address_cache.get_metrics()
+
+    await bot.send_message(message.chat.id,
+                           json.dumps(metrics,
+                                      ensure_ascii=False,
+                                      indent='    '))
+
+
 @dp.message_handler(commands=['unban'], state='*')
 async def unban_user_command(message: types.Message, state: FSMContext):
     if message.chat.id != config.ADMIN_ID:
@@ -3359,9 +3386,7 @@ async def unban_user_command(message: types.Message, state: FSMContext):
         await bot.send_message(message.chat.id, text)
         return
 
-    bans = await bot_storage.get_bans()
-    bans.pop(user_id, None)
-    await bot_storage.set_bans(bans)
+    await ban_list.unban(user_id)
 
     text = f'{user_id} {locales.text(language, "unbanned_succesfully")}'
     await bot.send_message(message.chat.id, text)
@@ -3386,9 +3411,7 @@ async def ban_user_command(message: types.Message, state: FSMContext):
         await bot.send_message(message.chat.id, text)
         return
 
-    bans = await bot_storage.get_bans()
-    bans[user_id] = caption
-    await bot_storage.set_bans(bans)
+    await ban_list.ban(user_id, caption)
 
     text = f'{user_id} {locales.text(language, "banned_succesfully")}'
     await bot.send_message(message.chat.id, text)
@@ -3854,7 +3877,7 @@ async def text_to_broadcast(message: types.Message, state: FSMContext):
     if receiver == SOCIAL_NETWORKS:
         await share_to_social_networks(message, str(types.ContentType.TEXT))
     elif receiver == USERS:
-        await share_to_users(message)
+        await share_to_users(message, language)
 
     await Form.operational_mode.set()
 
@@ -3876,7 +3899,7 @@ async def photo_to_broadcast(message: types.Message, state: FSMContext):
     if receiver == SOCIAL_NETWORKS:
         await share_to_social_networks(message, str(types.ContentType.PHOTO))
     elif receiver == USERS:
-        await share_to_users(message)
+        await share_to_users(message, language)
 
     await Form.operational_mode.set()
 
@@ -3899,7 +3922,7 @@ async def message_to_broadcast(message: types.Message, state: FSMContext):
         text = locales.text(language, 'simple_post_only')
         await bot.send_message(message.chat.id, text)
     elif receiver == USERS:
-        await share_to_users(message)
+        await share_to_users(message, language)
 
     await Form.operational_mode.set()
 
@@ -3922,9 +3945,11 @@ async def initial_violation_photo(message: types.Message, state: FSMContext):
     if post_from_channel(message):
         logger.info('Фотка из канала - ' + str(message.from_user.id))
         await police_response_sending(message, state)
-    else:
+        return
+
+    if album := await album_collector.collect(message):
         await photo_manager.clear_storage(message.chat.id)
-        await process_violation_photo(message, state)
+        await process_violation_photos(album, state)
 
 
 @dp.message_handler(content_types=types.ContentType.PHOTO,
@@ -3933,30 +3958,38 @@ async def process_violation_photo(message: types.Message, state: FSMContext):
     logger.info('Обрабатываем посылку еще фотки нарушения - ' +
                 f'{str(message.from_user.id)}:{message.from_user.username}')
 
+    if album := await album_collector.collect(message):
+        await process_violation_photos(album, state)
+
+
+async def process_violation_photos(messages: List[types.Message],
+                                   state: FSMContext):
     language = await get_ui_lang(state)
 
-    # Проверим есть ли место под еще одно фото нарушения
-    if await violation_storage_full(state):
+    # фотки одного пользователя обрабатываем по очереди, а разных - параллельно
+    async with user_locks.get(state.user), state.proxy() as data:
+        # Проверим есть ли место под еще фото нарушения
+        reserved = reserve_violation_photos(data, len(messages))
+
+        # Добавляем фотки наилучшего качества(последние в массивах) в список
+        # прикрепления в письме
+        photos = [message.photo[-1] for message in messages[:reserved]]
+        await add_photos_to_attachments(photos, data, messages[0].chat.id)
+
+    if reserved < len(messages):
         text = locales.text(language, 'violation_storage_full') +\
             str(config.MAX_VIOLATION_PHOTOS)
     else:
-        async with semaphore, state.proxy() as data:
-            # Добавляем фотку наилучшего качества(последнюю в массиве) в список
-            # прикрепления в письме
-            await add_photo_to_attachments(message.photo[-1],
-                                           data,
-                                           message.chat.id)
-
         text = locales.text(language, Form.violation_photo.state) + '\n' +\
             '\n' +\
             '👮🏻‍♂️' + ' ' + locales.text(language, 'photo_quality_warning')
 
     keyboard = get_photo_step_keyboard(language)
 
-    await message.reply(text,
-                        reply_markup=keyboard,
-                        parse_mode='HTML',
-                        disable_web_page_preview=True)
+    await messages[0].reply(text,
+                            reply_markup=keyboard,
+                            parse_mode='HTML',
+                            disable_web_page_preview=True)
 
     await Form.violation_photo.set()
 
@@ -4244,8 +4277,15 @@ async def create_global_objects():
     global bot_storage
     bot_storage = await BotStorage.create()
 
+    global appeal_storage
+    appeal_storage = await AppealStorage.create()
+
+    global ban_list
+    ban_list = BanList(bot_storage)
+
     global locator
     locator = Locator(loop)
+    locator.load_cached_boundaries()
 
     executors = {
         CANCEL_ON_IDLE: maybe_return_to_state,
@@ -4256,6 +4296,7 @@ async def create_global_objects():
     scheduler = Scheduler(bot_storage, executors, loop)
 
     locator.scheduler = scheduler
+    locator.address_cache = await AddressCache.create(ADDRESS_FAIL)
 
     global statistic
     statistic = Statistic(bot_storage)
@@ -4263,17 +4304,27 @@ async def create_global_objects():
     global photo_manager
     photo_manager = await PhotoManager.create(loop, bot)
 
+    global broadcaster
+    broadcaster = await Broadcaster.create(bot, locales)
+
 
 async def startup(dispatcher: Dispatcher):
     logger.info('Старт бота.')
+    await http_pool.get()
     await create_global_objects()
     logger.info('Подключаемся к очереди статусов обращений.')
     asyncio.ensure_future(rabbit_amqp.start(loop, status_received))
     logger.info('Подключились.')
+    logger.info('Запускаем отправку сообщений в очередь.')
+    await rabbit_publisher.start()
     logger.info('Загружаем границы регионов.')
     asyncio.ensure_future(locator.download_boundaries())
     logger.info('Запускаем планировщик.')
     asyncio.ensure_future(scheduler.start())
+    logger.info('Подписываемся на изменения банов.')
+    asyncio.ensure_future(ban_list.start())
+    logger.info('Продолжаем прерванную рассылку.')
+    asyncio.ensure_future(broadcaster.resume())
 
 
 async def shutdown(dispatcher: Dispatcher):
@@ -4281,6 +4332,9 @@ async def shutdown(dispatcher: Dispatcher):
 
     await dispatcher.storage.close()
     await dispatcher.storage.wait_closed()
+    await rabbit_publisher.close()
+    await redis_pool.close()
+    await http_pool.close()
 
 
 def main():
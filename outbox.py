@@ -0,0 +1,258 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# journal is rewritten with pending records only after this many
+# records are delivered
+COMPACT_AFTER = 1000
+
+# pauses between delivery attempts of a message grow up to this (seconds)
+MAX_RETRY_PAUSE = 300
+
+Record = Dict[str, Any]
+
+
+class Outbox:
+    """
+    Append-only journal of messages to deliver. Messages are accepted as
+    soon as they are written to disk and delivered in background with
+    retries, so nothing is lost while the receiver is down or the bot
+    restarts. Every message has an idempotency key, a message with the key
+    which is already pending is not added twice.
+
+    Messages of one group are delivered in order they were put, a message
+    is retried until delivered and holds up only the rest of its group.
+
+    Messages could contain credentials, files are readable by owner only.
+    """
+    def __init__(self,
+                 path: str,
+                 deliver: Callable[[str, Record], Awaitable[None]]):
+        self._path = path
+        self._deliver = deliver
+        self._pending: Dict[str, Record] = dict()
+        self._groups: Dict[str, str] = dict()
+        self._delivered_since_compaction = 0
+
+        # failed attempts and time of the next attempt of pending messages
+        self._attempts: Dict[str, int] = dict()
+        self._retry_at: Dict[str, float] = dict()
+
+        # lines waiting to be written and futures of their writers
+        self._lines: List[Tuple[str, asyncio.Future]] = []
+        self._has_lines = asyncio.Event()
+        self._has_pending = asyncio.Event()
+
+    async def start(self):
+        """
+        Restores pending messages from the journal and starts delivering
+        """
+        os.makedirs(os.path.dirname(self._path) or '.',
+                    mode=0o700,
+                    exist_ok=True)
+
+        self._read_journal()
+        self._compact(self._snapshot())
+
+        if self._pending:
+            logger.info(f'Неотправленных сообщений: {len(self._pending)}')
+            self._has_pending.set()
+
+        asyncio.ensure_future(self._write_lines())
+        asyncio.ensure_future(self._deliver_pending())
+
+    async def put(self, key: str, record: Record, group: str):
+        """
+        Returns when the message is safely on disk
+        """
+        if key in self._pending:
+            logger.info(f'Сообщение уже ждет отправки - {key}')
+            return
+
+        self._pending[key] = record
+        self._groups[key] = group
+
+        try:
+            await self._append({'key': key, 'group': group, 'record': record})
+        except Exception:
+            self._pending.pop(key, None)
+            self._groups.pop(key, None)
+            raise
+
+        self._has_pending.set()
+
+    async def _append(self, line: Record):
+        written = asyncio.get_event_loop().create_future()
+        self._lines.append((json.dumps(line, ensure_ascii=False), written))
+        self._has_lines.set()
+        await written
+
+    async def _write_lines(self):
+        """
+        Lines collected while the previous batch was written are written
+        together with one fsync
+        """
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self._has_lines.wait()
+            self._has_lines.clear()
+
+            lines, self._lines = self._lines, []
+
+            try:
+                await loop.run_in_executor(None,
+                                           self._write,
+                                           [line for line, _ in lines])
+            except Exception as exc:
+                logger.exception('Не удалось записать исходящие сообщения')
+
+                for _, written in lines:
+                    written.set_exception(exc)
+            else:
+                for _, written in lines:
+                    written.set_result(None)
+
+            if self._delivered_since_compaction >= COMPACT_AFTER:
+                self._delivered_since_compaction = 0
+
+                await loop.run_in_executor(None,
+                                           self._compact,
+                                           self._snapshot())
+
+    async def _deliver_pending(self):
+        while True:
+            self._has_pending.clear()
+            now = time.monotonic()
+
+            due = [key for key in self._group_heads()
+                   if self._retry_at.get(key, 0) <= now]
+
+            for key in due:
+                try:
+                    await self._deliver(key, self._pending[key])
+                except Exception:
+                    logger.exception(f'Не удалось доставить сообщение - {key}')
+                    self._retry_later(key)
+                else:
+                    await self._forget(key)
+
+            try:
+                await asyncio.wait_for(self._has_pending.wait(),
+                                       self._next_retry_pause())
+            except asyncio.TimeoutError:
+                pass
+
+    def _group_heads(self) -> List[str]:
+        """
+        The oldest pending message of every group, the rest of a group
+        waits for it
+        """
+        heads: Dict[str, str] = dict()
+
+        for key in self._pending:
+            heads.setdefault(self._groups[key], key)
+
+        return list(heads.values())
+
+    def _next_retry_pause(self) -> Optional[float]:
+        """
+        Time to the closest retry, None if nothing is pending
+        """
+        heads = self._group_heads()
+
+        if not heads:
+            return None
+
+        closest = min(self._retry_at.get(key, 0) for key in heads)
+        return max(closest - time.monotonic(), 0)
+
+    def _retry_later(self, key: str):
+        attempts = self._attempts.get(key, 0) + 1
+        self._attempts[key] = attempts
+
+        pause = min(2 ** (attempts - 1), MAX_RETRY_PAUSE)
+        self._retry_at[key] = time.monotonic() + pause
+
+    async def _forget(self, key: str):
+        """
+        Message is delivered, it's not needed in the journal
+        """
+        self._pending.pop(key, None)
+        self._groups.pop(key, None)
+        self._attempts.pop(key, None)
+        self._retry_at.pop(key, None)
+        self._delivered_since_compaction += 1
+
+        try:
+            await self._append({'delivered': key})
+        except Exception:
+            # the message will only be delivered once more after restart
+            logger.exception(f'Не удалось отметить доставку - {key}')
+
+    def _snapshot(self) -> List[Tuple[str, str, Record]]:
+        return [(key, self._groups[key], record)
+                for key, record in self._pending.items()]
+
+    def _write(self, lines: List[str]):
+        with _open_private(self._path, 'a') as journal:
+            journal.write(''.join(map(lambda line: line + '\n', lines)))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _read_journal(self):
+        try:
+            with open(self._path, encoding='utf8') as journal:
+                for raw_line in journal:
+                    try:
+                        line = json.loads(raw_line)
+                    except json.JSONDecodeError:
+                        # line torn by crash during writing
+                        continue
+
+                    if 'delivered' in line:
+                        self._pending.pop(line['delivered'], None)
+                        self._groups.pop(line['delivered'], None)
+                    else:
+                        self._pending[line['key']] = line['record']
+
+                        # lines written before groups appeared
+                        self._groups[line['key']] = \
+                            line.get('group', line['key'])
+        except FileNotFoundError:
+            pass
+
+    def _compact(self, pending: List[Tuple[str, str, Record]]):
+        """
+        Replaces the journal with pending messages only. Called when
+        nothing else writes to the journal.
+        """
+        temp_path = self._path + '.tmp'
+
+        with _open_private(temp_path, 'w') as journal:
+            for key, group, record in pending:
+                line = {'key': key, 'group': group, 'record': record}
+                journal.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        os.replace(temp_path, self._path)
+
+
+def _open_private(path: str, mode: str):
+    """
+    Opens the file for writing, it's made readable by owner only
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if mode == 'a' else os.O_TRUNC
+    descriptor = os.open(path, flags, 0o600)
+
+    # files created by previous versions could be readable by others
+    os.fchmod(descriptor, 0o600)
+    return os.fdopen(descriptor, mode, encoding='utf8')
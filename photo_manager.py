@@ -14,6 +14,7 @@ from aiogram import Bot
 from aiogram.types.photo_size import PhotoSize
 
 import config
+import http_pool
 from numberplates import recognize_numberplates
 from telegraph import Telegraph
 from user_storage import UserStorage
@@ -22,6 +23,9 @@ logger = logging.getLogger(__name__)
 CURRENT = "current"
 STORAGE_PREFIX = "photo_manager"
 
+# everything stored in data storage for every appeal
+PHOTO_DATA_KEYS = ('file_paths', 'urls', 'numberplates', 'page_url')
+
 
 class PhotoManager:
     def __init__(self, loop: AbstractEventLoop, bot: Bot):
@@ -57,41 +61,44 @@ class PhotoManager:
         except Exception:
             return False
 
-    def stash_photo(self, user_id: int, photo_tg_object: PhotoSize):
-        tasks: list
+    def stash_photos(self, user_id: int, photo_tg_objects: List[PhotoSize]):
+        """
+        Starts storing, recognition and uploading of all photos at once,
+        e.g. of a whole album
+        """
+        storing_tasks = []
+
+        for photo_tg_object in photo_tg_objects:
+            storing_tasks.append(asyncio.create_task(
+                self.store_photo(user_id, photo_tg_object)
+            ))
 
         with self.tasks(self.task_storage,
                         list(),
                         str(user_id),
                         CURRENT,
                         'store_photo_tasks') as tasks:
-            storing_task = asyncio.create_task(
-                self.store_photo(user_id, photo_tg_object)
-            )
-
-            tasks.append(storing_task)
+            tasks.extend(storing_tasks)
 
         with self.tasks(self.task_storage,
                         list(),
                         str(user_id),
                         CURRENT,
                         'numberplate_tasks') as tasks:
-            numberplate_task = asyncio.create_task(
-                self.recognize_numberplate(user_id, storing_task)
-            )
-
-            tasks.append(numberplate_task)
+            for storing_task in storing_tasks:
+                tasks.append(asyncio.create_task(
+                    self.recognize_numberplate(user_id, storing_task)
+                ))
 
         with self.tasks(self.task_storage,
                         list(),
                         str(user_id),
                         CURRENT,
                         'upload_to_cloud_tasks') as tasks:
-            upload_to_cloud_task = asyncio.create_task(
-                self.upload_to_cloud(user_id, storing_task)
-            )
-
-            tasks.append(upload_to_cloud_task)
+            for storing_task in storing_tasks:
+                tasks.append(asyncio.create_task(
+                    self.upload_to_cloud(user_id, storing_task)
+                ))
 
     async def store_photo(self,
                           user_id: int,
@@ -134,6 +141,14 @@ class PhotoManager:
 
         return recognized_numbers
 
+    def _replace_current(self,
+                         items: list,
+                         appeal_id: Union[int, str]) -> List[str]:
+        return list(map(
+            lambda item: item.replace(CURRENT, str(appeal_id)),
+            items
+        ))
+
     def get_unique_file_path(self, folder_path: str, file_name: str) -> str:
         timestamp = str(time.time()).replace('.', '')
         file_path = os.path.join(folder_path, timestamp + file_name)
@@ -172,58 +187,30 @@ class PhotoManager:
         await self._wait_for_done(user_id, CURRENT, 'upload_to_cloud_tasks')
         await self._wait_for_done(user_id, CURRENT, 'page_tasks')
 
-        # rename folder_name in file paths
-        old_paths: list = await self.data_storage.get_full_set(
-            user_id,
-            key=f'{CURRENT}:file_paths')
+        async with self.data_storage.batch(user_id) as batch:
+            old_paths = batch.get_set(f'{CURRENT}:file_paths')
+            old_numberplates = batch.get_set(f'{CURRENT}:numberplates')
+            old_urls = batch.get_set(f'{CURRENT}:urls')
+            page_url = batch.get_value(f'{CURRENT}:page_url')
 
-        file_paths = list(map(
-            lambda path: path.replace(CURRENT, str(appeal_id)),
-            old_paths
-        ))
+        async with self.data_storage.batch(user_id) as batch:
+            # rename folder_name in file paths
+            batch.add_set_member(
+                f'{appeal_id}:file_paths',
+                *self._replace_current(old_paths.result(), appeal_id))
 
-        await self.data_storage.add_set_member(
-            user_id,
-            f'{appeal_id}:file_paths',
-            *file_paths)
+            # rename folder_name in numberplates
+            batch.add_set_member(
+                f'{appeal_id}:numberplates',
+                *self._replace_current(old_numberplates.result(), appeal_id))
 
-        # rename folder_name in numberplates
-        old_numberplates_path: list = await self.data_storage.get_full_set(
-            user_id,
-            key=f'{CURRENT}:numberplates')
+            # rename folder_name in urls
+            batch.add_set_member(
+                f'{appeal_id}:urls',
+                *self._replace_current(old_urls.result(), appeal_id))
 
-        numberplates = list(map(
-            lambda path: path.replace(CURRENT, str(appeal_id)),
-            old_numberplates_path
-        ))
-
-        await self.data_storage.add_set_member(
-            user_id,
-            f'{appeal_id}:numberplates',
-            *numberplates)
-
-        # rename folder_name in urls
-        old_urls: list = await self.data_storage.get_full_set(
-            user_id,
-            key=f'{CURRENT}:urls')
-
-        new_urls = list(map(
-            lambda path: path.replace(CURRENT, str(appeal_id)),
-            old_urls
-        ))
-
-        await self.data_storage.add_set_member(
-            user_id,
-            f'{appeal_id}:urls',
-            *new_urls)
-
-        # rename folder name in page_url
-        page_url: str = await self.data_storage.get(user_id,
-                                                    f'{CURRENT}:page_url')
-
-        await self.data_storage.set(user_id,
-                                    key=f'{appeal_id}:page_url',
-                                    value=page_url)
+            # rename folder name in page_url
+            batch.set_value(f'{appeal_id}:page_url', page_url.result())
 
         # rename key in task storage
         with self.tasks(self.task_storage, dict(), str(user_id)) as user_stash:
@@ -241,20 +228,15 @@ class PhotoManager:
         await self._wait_for_done(user_id, appeal_id, 'upload_to_cloud_tasks')
         await self._wait_for_done(user_id, appeal_id, 'page_tasks')
 
-        appeal_stash = dict()
-
-        appeal_stash['urls'] = await self.data_storage.get_full_set(
-            user_id,
-            f'{appeal_id}:urls')
-
-        appeal_stash['file_paths'] = await self.data_storage.get_full_set(
-            user_id,
-            f'{appeal_id}:file_paths')
-
-        appeal_stash['page_url'] = await self.data_storage.get(
-            user_id,
-            f'{appeal_id}:page_url')
+        async with self.data_storage.batch(user_id) as batch:
+            urls = batch.get_set(f'{appeal_id}:urls')
+            file_paths = batch.get_set(f'{appeal_id}:file_paths')
+            page_url = batch.get_value(f'{appeal_id}:page_url')
 
+        appeal_stash = dict()
+        appeal_stash['urls'] = urls.result()
+        appeal_stash['file_paths'] = file_paths.result()
+        appeal_stash['page_url'] = page_url.result()
         return appeal_stash
 
     async def numberplate_tasks_in_progress(
@@ -364,9 +346,9 @@ class PhotoManager:
     async def _clear_data_storage(self,
                                   user_id: int,
                                   appeal_id: Union[int, str]):
-        await self.data_storage.delete_by_pattern(
-            user_id,
-            pattern=f'{str(appeal_id)}:*')
+        # keys are known in advance, so no pattern matching is needed
+        keys = map(lambda key: f'{str(appeal_id)}:{key}', PHOTO_DATA_KEYS)
+        await self.data_storage.delete(user_id, *keys)
 
     async def _upload_photo(self, file_path: str) -> str:
         return await self._upload_photo_to_telegraph(file_path) or \
@@ -398,10 +380,11 @@ class PhotoManager:
                 upload_url = 'https://telegra.ph/upload'
 
                 try:
-                    async with aiohttp.ClientSession() as http_session:
-                        async with http_session.post(upload_url,
-                                                     data=form) as r:
-                            result = await r.json()
+                    http_session = await http_pool.get()
+
+                    async with http_session.post(upload_url,
+                                                 data=form) as r:
+                        result = await r.json()
                 except Exception:
                     logger.exception("Error while upload photo to telegraph")
                     result = None
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+import aio_pika
+
+import config
+from exceptions import ErrorWhilePutInQueue
+from outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for broker confirmation of a message
+PUBLISH_TIMEOUT = 10
+
+
+class Rabbit:
+    """
+    Publishes over one long-lived AMQP channel with publisher confirms.
+    Robust connection restores the channel after connection loss.
+
+    Messages are put to the outbox on disk first and published from it in
+    background, so sending doesn't depend on the broker being available.
+    """
+    def __init__(self):
+        self._connection: Optional[aio_pika.RobustConnection] = None
+        self._channel: Optional[aio_pika.RobustChannel] = None
+        self._exchanges: Dict[str, aio_pika.Exchange] = dict()
+        self._lock = asyncio.Lock()
+        self._outbox = Outbox(config.RABBIT_OUTBOX_PATH, self._publish)
+
+    async def start(self):
+        await self._outbox.start()
+
+    async def _get_exchange(self, exchange_name: str) -> aio_pika.Exchange:
+        async with self._lock:
+            if self._connection is None or self._connection.is_closed:
+                logger.info('Подключаемся к раббиту для отправки')
+
+                self._connection = await aio_pika.connect_robust(
+                    config.RABBIT_AMQP_ADDRESS)
+
+                self._channel = None
+
+            if self._channel is None or self._channel.is_closed:
+                self._channel = await self._connection.channel(
+                    publisher_confirms=True)
+
+                self._exchanges = dict()
+
+            if exchange_name not in self._exchanges:
+                self._exchanges[exchange_name] = \
+                    await self._channel.get_exchange(exchange_name)
+
+        return self._exchanges[exchange_name]
+
+    async def _send(self,
+                    exchange_name: str,
+                    routing_key: str,
+                    body: dict,
+                    key: str) -> None:
+        """
+        Key identifies the message for the receiver, so a message published
+        twice (e.g. after restart) could be recognized. Messages about one
+        appeal are published in order they were sent.
+        """
+        group = f'{body["user_id"]}:{body["appeal_id"]}'
+
+        record = {
+            'exchange': exchange_name,
+            'routing_key': routing_key,
+            'body': body,
+        }
+
+        try:
+            await self._outbox.put(key, record, group)
+        except Exception as exc:
+            raise ErrorWhilePutInQueue(
+                f'Ошибка при отправке обращения: {exc}') from exc
+
+    async def _publish(self, key: str, record: dict) -> None:
+        message = aio_pika.Message(
+            body=json.dumps(record['body']).encode('utf8'),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            message_id=key)
+
+        exchange = await self._get_exchange(record['exchange'])
+
+        # unroutable messages are dropped by broker as before with
+        # publishing through the management api
+        await exchange.publish(message,
+                               record['routing_key'],
+                               mandatory=False,
+                               timeout=PUBLISH_TIMEOUT)
+
+    async def close(self):
+        if self._connection is not None and not self._connection.is_closed:
+            await self._connection.close()
+
+    async def send_appeal(self,
+                          appeal: dict,
+                          user_id: int) -> None:
+        body = {
+            'type': config.APPEAL,
+            'appeal': appeal,
+            'appeal_id': appeal['appeal_id'],
+            'user_id': user_id,
+            'sender_email': appeal['sender_email'],
+            'sender_email_password': appeal['sender_email_password'],
+        }
+
+        await self._send(config.RABBIT_EXCHANGE_MANAGING,
+                         config.RABBIT_ROUTING_APPEAL_TO_QUEUE,
+                         body,
+                         f'{config.APPEAL}:{user_id}:{appeal["appeal_id"]}')
+
+    async def send_cancel(self,
+                          appeal_id: int,
+                          user_id: int,
+                          routing_key: str) -> None:
+        body = {
+            'type': config.CANCEL,
+            'appeal_id': appeal_id,
+            'user_id': user_id,
+        }
+
+        await self._send(config.RABBIT_EXCHANGE_SENDING,
+                         routing_key,
+                         body,
+                         f'{config.CANCEL}:{user_id}:{appeal_id}')
+
+    async def send_sharing(self, body: dict) -> None:
+        key = f'sharing:{body["user_id"]}:{body["appeal_id"]}:' + \
+            f'{body["reply_type"]}:{body["reply_id"]}'
+
+        await self._send(config.RABBIT_EXCHANGE_SHARING,
+                         config.RABBIT_ROUTING_VIOLATION,
+                         body,
+                         key)
+
+    async def send_captcha_text(self,
+                                captcha_text: str,
+                                user_id: int,
+                                appeal_id: int,
+                                appeal_email: Optional[str],
+                                routing_key: str) -> None:
+        body = {
+            'type': config.CAPTCHA_TEXT,
+            'captcha_text': captcha_text,
+            'user_id': user_id,
+            'appeal_id': appeal_id,
+            'sender_email': appeal_email,
+        }
+
+        # captcha could be entered again for the same appeal
+        key = f'{config.CAPTCHA_TEXT}:{user_id}:{appeal_id}:{captcha_text}'
+
+        await self._send(config.RABBIT_EXCHANGE_SENDING,
+                         routing_key,
+                         body,
+                         key)
@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Allows not more than `rate` actions per second with bursts up to
+    `capacity` actions
+    """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """
+        Nothing is acquired until the pause is over
+        """
+        self._paused_until = max(self._paused_until,
+                                 time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while (pause := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+
+            self._refill()
+
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+
+            self._tokens -= 1
+
+    def _refill(self):
+        now = time.monotonic()
+        passed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + passed * self.rate)
+        self._updated_at = now
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aioredis
+from aioredis import Redis
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class RedisPool:
+    """
+    Process-wide redis connections pool. Every storage borrows connections
+    from it instead of keeping its own.
+    """
+    def __init__(self):
+        self._redis: Optional[Redis] = None
+        self._lock = asyncio.Lock()
+        self._health_check: Optional[asyncio.Future] = None
+
+    async def get(self) -> Redis:
+        async with self._lock:
+            if self._redis is None or self._redis.closed:
+                self._redis = await self._connect()
+
+        return self._redis
+
+    async def _connect(self) -> Redis:
+        logger.info('Создаем пул соединений с редисом')
+
+        redis = await aioredis.create_redis_pool(
+            f'redis://{config.REDIS_HOST}:{config.REDIS_PORT}',
+            password=config.REDIS_PASSWORD,
+            minsize=config.REDIS_POOL_MIN_SIZE,
+            maxsize=config.REDIS_POOL_MAX_SIZE)
+
+        if self._health_check is None or self._health_check.done():
+            self._health_check = asyncio.ensure_future(self._check_health())
+
+        return redis
+
+    async def _check_health(self):
+        while True:
+            await asyncio.sleep(config.REDIS_HEALTH_CHECK_INTERVAL)
+
+            if self._redis is None or self._redis.closed:
+                return
+
+            try:
+                await self._redis.ping()
+            except Exception:
+                logger.exception('Редис не отвечает, сбрасываем соединения')
+
+                # broken idle connections will be recreated on next acquire
+                await self._redis.connection.clear()
+
+    async def close(self):
+        if self._health_check is not None:
+            self._health_check.cancel()
+
+        if self._redis is not None and not self._redis.closed:
+            self._redis.close()
+            await self._redis.wait_closed()
+
+
+pool = RedisPool()
+
+
+async def get() -> Redis:
+    return await pool.get()
+
+
+async def close():
+    await pool.close()
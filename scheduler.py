@@ -1,10 +1,14 @@
 import asyncio
+import heapq
 import logging
+import time
 from asyncio import AbstractEventLoop
-from typing import Callable, Dict
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
 
 import datetime_parser
 from bot_storage import BotStorage
+from rate_limiter import TokenBucket
 
 logger = logging.getLogger(__name__)
 
@@ -12,14 +16,48 @@ RELOAD_BOUNDARY = 'reload_boundary'
 CANCEL_ON_IDLE = 'cancel_on_idle'
 
 ONE_PER_USER = 'one_per_user'
+CONCURRENCY = 'concurrency'
+RATE = 'rate'
 
+# how many due tasks to take from the storage at once
+POP_LIMIT = 100
+
+# max pause between checks for tasks added by other bot processes (seconds)
+MAX_SLEEP = 300
+
+# max amount of claimed tasks waiting for or being executed by this process
+MAX_IN_FLIGHT = 200
+
+# claimed task returns to the queue if its lease isn't prolonged in this
+# time (seconds)
+LEASE_TIMEOUT = 300
+
+# lease of a waiting or running task is prolonged this often (seconds)
+LEASE_PROLONG_PAUSE = LEASE_TIMEOUT / 3
+
+# how many times a task is tried before it's dropped
+MAX_ATTEMPTS = 3
+
+# pause before next attempt of failed task (seconds)
+RETRY_PAUSE = 60
+
+# due times which aren't of a particular task
+NEXT_STORED_TASK = 'next_stored_task'
+LEASE_EXPIRATION = 'lease_expiration'
+
+# CONCURRENCY - max amount of simultaneously running tasks of the type
+# RATE - max amount of tasks of the type started per second
 task_types = {
     RELOAD_BOUNDARY: {
         ONE_PER_USER: False,
+        CONCURRENCY: 2,
+        RATE: 1,
     },
 
     CANCEL_ON_IDLE: {
         ONE_PER_USER: True,
+        CONCURRENCY: 10,
+        RATE: 20,
     }
 }
 
@@ -32,76 +70,267 @@ class Scheduler():
         self.executors = executors
         self.loop = loop
 
+        # task id -> due time, the heap could also have superseded due times
+        # of rescheduled tasks which are skipped
+        self._due_times: Dict[str, float] = dict()
+        self._due_heap: List[Tuple[float, str]] = []
+        self._wakeup = asyncio.Event()
+        self._in_flight = 0
+        self._limits: Dict[str, asyncio.Semaphore] = dict()
+        self._rate_limiters: Dict[str, TokenBucket] = dict()
+        self._metrics: Dict[str, dict] = dict()
+
+        for task_type, settings in task_types.items():
+            self._limits[task_type] = asyncio.Semaphore(settings[CONCURRENCY])
+            self._rate_limiters[task_type] = TokenBucket(settings[RATE])
+
+            self._metrics[task_type] = {
+                'waiting': 0,
+                'running': 0,
+                'done': 0,
+                'failed': 0,
+                'last_lag': 0.0,
+                'max_lag': 0.0,
+            }
+
     async def start(self):
         logger.info('Запуск шедулера')
+        await self._move_legacy_tasks()
+        await self._load_next_due_time()
+
+        while True:
+            await self._wait_for_due_time()
+            await self.handle_tasks()
+            self._forget_passed_due_times()
+            await self._load_next_due_time()
 
+    async def _wait_for_due_time(self):
+        """
+        Sleep until the earliest known task is due or a new earlier task is
+        added
+        """
         while True:
-            async with self.storage.tasks() as tasks:
-                empty_users = list()
+            self._wakeup.clear()
+            timeout = MAX_SLEEP
+
+            # running tasks wake us up when they are done
+            next_due_time = self._next_due_time()
+
+            if next_due_time is not None and self._in_flight < MAX_IN_FLIGHT:
+                timeout = min(next_due_time - time.time(), MAX_SLEEP)
+
+            if timeout <= 0:
+                return
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def _next_due_time(self) -> Optional[float]:
+        while self._due_heap:
+            due_time, due_id = self._due_heap[0]
+
+            if self._due_times.get(due_id) == due_time:
+                return due_time
+
+            heapq.heappop(self._due_heap)
+
+        return None
+
+    def _forget_passed_due_times(self):
+        current_time = time.time()
+
+        while (due_time := self._next_due_time()) is not None and \
+                due_time <= current_time:
+            _, due_id = heapq.heappop(self._due_heap)
+            del self._due_times[due_id]
+
+    async def _load_next_due_time(self):
+        """
+        Tasks could be added before start or by other bot processes
+        """
+        next_due_time = await self.storage.get_next_task_time()
 
-                for user_id in tasks:
-                    user_tasks: list = tasks[user_id]
-                    user_tasks = await self.handle_tasks(user_tasks)
-                    tasks[user_id] = user_tasks
+        if next_due_time is not None:
+            self._remember_due_time(next_due_time, NEXT_STORED_TASK)
 
-                    if not user_tasks:
-                        empty_users.append(user_id)
+    def _remember_due_time(self, due_time: float, due_id: str):
+        """
+        New due time of the same id supersedes the previous one
+        """
+        if self._due_times.get(due_id) == due_time:
+            return
 
-                if empty_users:
-                    self._delete_user_queue(tasks, *empty_users)
+        self._due_times[due_id] = due_time
+        heapq.heappush(self._due_heap, (due_time, due_id))
 
-            await asyncio.sleep(60)
+        # drop superseded due times when they are the majority
+        if len(self._due_heap) > 2 * len(self._due_times):
+            self._due_heap = [(due_time, due_id) for due_id, due_time
+                              in self._due_times.items()]
 
-    def _delete_user_queue(self, tasks: dict, user: int, *users):
-        for user_id in (user, *users):
-            tasks.pop(user_id, None)
+            heapq.heapify(self._due_heap)
 
-    async def handle_tasks(self, user_tasks: list) -> list:
-        current_time_str = datetime_parser.get_current_datetime_str()
-        current_time = datetime_parser.get_current_datetime()
-        tasks_to_delete = []
+        if self._next_due_time() == due_time:
+            self._wakeup.set()
 
-        for task_num, task in enumerate(user_tasks):
-            execute_time = task.get('execute_time', current_time_str)
-            execute_time = datetime_parser.datetime_from_string(execute_time)
+    async def _move_legacy_tasks(self):
+        tasks = await self.storage.pop_legacy_scheduled_tasks()
 
-            if current_time >= execute_time:
-                tasks_to_delete.append(task_num)
-                executor = self.executors[task['executor']]
-                kvargs = task['kvargs']
-                asyncio.ensure_future(self.execute(executor, kvargs))
+        for user_tasks in tasks.values():
+            for task in user_tasks:
+                await self.add_task(task)
 
-        tasks_to_delete = reversed(tasks_to_delete)
+    async def handle_tasks(self):
+        current_time = time.time()
+        tasks_amount = 0
+        limit = min(POP_LIMIT, MAX_IN_FLIGHT - self._in_flight)
 
-        for task_num in tasks_to_delete:
-            user_tasks.pop(task_num)
+        # there could be more due tasks than we take at once,
+        # but leave them in the queue while executors are busy
+        while limit > 0:
+            tasks = await self.storage.claim_due_tasks(current_time,
+                                                       limit,
+                                                       LEASE_TIMEOUT,
+                                                       MAX_ATTEMPTS)
+            tasks_amount += len(tasks)
 
-        return user_tasks
+            for task_id, task in tasks:
+                self._in_flight += 1
+                asyncio.ensure_future(self.execute(task_id, task))
 
-    async def execute(self, executor: Callable, kvargs: dict):
+            if len(tasks) < limit:
+                break
+
+            limit = min(POP_LIMIT, MAX_IN_FLIGHT - self._in_flight)
+
+        if tasks_amount:
+            # wake up to return tasks of crashed executors to the queue
+            self._remember_due_time(current_time + LEASE_TIMEOUT,
+                                    LEASE_EXPIRATION)
+
+    async def execute(self, task_id: str, task: dict):
         try:
-            await executor(**kvargs)
+            await self._execute_leased(task_id, task)
         except Exception:
-            logger.exception('Задание упало')
+            logger.exception(f'Задание упало: {task_id}')
+            await self._retry(task_id)
+        else:
+            await self.storage.acknowledge_task(task_id)
+        finally:
+            self._in_flight -= 1
+            self._wakeup.set()
+
+    async def _execute_leased(self, task_id: str, task: dict):
+        """
+        Lease is kept while the task waits for its turn and runs, so a slow
+        task isn't given to another executor
+        """
+        lease = asyncio.ensure_future(self._prolong_lease(task_id))
+
+        try:
+            await self._execute_limited(task)
+        finally:
+            lease.cancel()
+
+    async def _prolong_lease(self, task_id: str):
+        while True:
+            await asyncio.sleep(LEASE_PROLONG_PAUSE)
+            lease_expiration = time.time() + LEASE_TIMEOUT
+
+            if not await self.storage.prolong_task_lease(task_id,
+                                                         lease_expiration):
+                logger.warning(f'Задание потеряло аренду: {task_id}')
+                return
+
+    async def _execute_limited(self, task: dict):
+        task_type = task['executor']
+        executor = self.executors[task_type]
+        metrics = self._metrics[task_type]
+        metrics['waiting'] += 1
+
+        async with self._limits[task_type]:
+            await self._rate_limiters[task_type].acquire()
+            metrics['waiting'] -= 1
+            metrics['running'] += 1
+            self._count_lag(task)
+
+            try:
+                await executor(**task['kvargs'])
+                metrics['done'] += 1
+            except Exception:
+                metrics['failed'] += 1
+                raise
+            finally:
+                metrics['running'] -= 1
+
+    def _count_lag(self, task: dict):
+        execute_time = task.get('execute_time')
+
+        if not execute_time:
+            return
+
+        metrics = self._metrics[task['executor']]
+        execute_at = datetime_parser.datetime_from_string(execute_time)
+        lag = max(time.time() - execute_at.timestamp(), 0)
+        metrics['last_lag'] = round(lag, 3)
+        metrics['max_lag'] = max(metrics['max_lag'], metrics['last_lag'])
+
+    async def get_metrics(self) -> dict:
+        queue_size, leased, next_due_time = \
+            await self.storage.get_tasks_queue_info()
+
+        queue_lag = 0.0
+
+        if next_due_time is not None:
+            queue_lag = round(max(time.time() - next_due_time, 0), 3)
+
+        return {
+            'queue_size': queue_size,
+            'leased': leased,
+            'queue_lag': queue_lag,
+            'in_flight': self._in_flight,
+            'task_types': self._metrics,
+        }
+
+    async def _retry(self, task_id: str):
+        execute_at = time.time() + RETRY_PAUSE
+
+        if await self.storage.retry_task(task_id, execute_at, MAX_ATTEMPTS):
+            self._remember_due_time(execute_at, task_id)
+        else:
+            logger.warning(f'Задание больше не повторяем: {task_id}')
 
     async def add_task(self, task: dict):
-        async with self.storage.tasks() as tasks:
-            user_id = str(task['user_id'])
-            user_tasks: list = tasks.get(user_id, [])
-            task_type: str = task['executor']
+        user_id = str(task['user_id'])
+        task_type: str = task['executor']
+
+        logger.info(f'Добавляем задание в шедулер: ' +
+                    f'{task_type} - {user_id}')
+
+        execute_time = task.get('execute_time',
+                                datetime_parser.get_current_datetime_str())
+
+        execute_at = \
+            datetime_parser.datetime_from_string(execute_time).timestamp()
 
-            logger.info(f'Добавляем задание в шедулер: ' +
-                        f'{task_type} - {user_id}')
+        task_id = self._get_task_id(task)
+        await self.storage.add_scheduled_task(task_id, task, execute_at)
+        self._remember_due_time(execute_at, task_id)
 
-            unique_task = task_types[task_type][ONE_PER_USER]
+    def _get_task_id(self, task: dict) -> str:
+        """
+        Unique tasks have the same id for the same user so the new one just
+        replaces the previous one
+        """
+        task_type: str = task['executor']
+        task_id = f'{task_type}:{str(task["user_id"])}'
 
-            if unique_task:
-                for task_num, user_task in enumerate(user_tasks):
-                    if user_task['executor'] == task_type:
-                        user_tasks.pop(task_num)
+        if task_types[task_type][ONE_PER_USER]:
+            return task_id
 
-            user_tasks.append(task)
-            tasks[user_id] = user_tasks
+        return f'{task_id}:{uuid4().hex}'
 
     def add_executor(self, task_type: str, executor: Callable):
         self.executors[task_type] = executor
@@ -1,11 +1,16 @@
+import asyncio
 import json
 import logging
-from typing import Any, Callable
+import zlib
+from contextlib import asynccontextmanager
+from typing import (Any, AsyncIterator, Awaitable, Callable, List, Optional,
+                    Tuple)
 
 import aioredis
 from aioredis import Redis
 
 import config
+import redis_pool
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +29,159 @@ def safe_redis(func: Callable) -> Callable:
     return try_function
 
 
+def decode_value(raw_value: Any, default: Any) -> Any:
+    if raw_value is None:
+        return default
+
+    value = json.loads(raw_value)
+    return value or default
+
+
+def encode_compressed_value(value: Any) -> bytes:
+    return zlib.compress(json.dumps(value).encode('utf8'))
+
+
+def decode_compressed_value(raw_value: Any, default: Any) -> Any:
+    if raw_value is None:
+        return default
+
+    return decode_value(zlib.decompress(raw_value), default)
+
+
+def decode_hash_value(raw_value: Any, default: Any) -> Any:
+    """
+    Unlike decode_value keeps falsy values, the field exists anyway
+    """
+    if raw_value is None:
+        return default
+
+    return json.loads(raw_value)
+
+
+def decode_hash(raw_values: Any, default: Any) -> Any:
+    value = {field.decode('utf8'): json.loads(raw_value)
+             for field, raw_value in (raw_values or {}).items()}
+
+    return value or default
+
+
+def decode_set(raw_values: Any, default: Any) -> Any:
+    value = list(map(lambda raw_value: raw_value.decode('utf8'),
+                     raw_values or []))
+
+    return value or default
+
+
+def decode_lowest_score(members: Any, default: Any) -> Any:
+    if not members:
+        return default
+
+    _, score = members[0]
+    return float(score)
+
+
+class StorageBatch:
+    """
+    Collects reads and writes to send them to redis in one round trip.
+    Read results are available after the batch is executed.
+    """
+    def __init__(self, redis: Redis, prefix: str):
+        self.PREFIX = prefix
+        self._transaction = redis.multi_exec()
+        self._reads: List[Tuple[Awaitable, Callable, Any, asyncio.Future]] = []
+
+    def _read(self,
+              raw_result: Awaitable,
+              decode: Callable,
+              default: Any) -> asyncio.Future:
+        result = asyncio.get_event_loop().create_future()
+        self._reads.append((raw_result, decode, default, result))
+        return result
+
+    def get_value(self, key: str, default: Any = dict()) -> asyncio.Future:
+        key = self.PREFIX + key
+
+        return self._read(self._transaction.get(key),
+                          decode_value,
+                          default)
+
+    def set_value(self, key: str, value: Any):
+        key = self.PREFIX + key
+        raw_value = json.dumps(value)
+        self._transaction.set(key, raw_value)
+
+    def get_set(self, key: str, default: Any = ()) -> asyncio.Future:
+        key = self.PREFIX + key
+
+        return self._read(self._transaction.smembers(key),
+                          decode_set,
+                          default)
+
+    def add_set_member(self, key: str, *values):
+        if not values:
+            return
+
+        key = self.PREFIX + key
+        self._transaction.sadd(key, *values)
+
+    def delete(self, key: str, *keys):
+        keys = (*keys, key)
+        keys = map(lambda key: self.PREFIX + key, keys)
+        self._transaction.delete(*keys)
+
+    def increment(self, key: str, amount: int = 1) -> asyncio.Future:
+        key = self.PREFIX + key
+
+        return self._read(self._transaction.incrby(key, amount),
+                          lambda value, default: int(value),
+                          None)
+
+    def expire(self, key: str, seconds: int):
+        key = self.PREFIX + key
+        self._transaction.expire(key, seconds)
+
+    def set_hash_value(self, key: str, field: str, value: Any):
+        key = self.PREFIX + key
+        raw_value = json.dumps(value)
+        self._transaction.hset(key, field, raw_value)
+
+    def delete_hash_field(self, key: str, field: str):
+        key = self.PREFIX + key
+        self._transaction.hdel(key, field)
+
+    def add_sorted_set_member(self, key: str, member: str, score: float):
+        key = self.PREFIX + key
+        self._transaction.zadd(key, score, member)
+
+    def count_sorted_set(self, key: str) -> asyncio.Future:
+        key = self.PREFIX + key
+
+        return self._read(self._transaction.zcard(key),
+                          lambda value, default: int(value),
+                          0)
+
+    def get_lowest_score(self, key: str) -> asyncio.Future:
+        key = self.PREFIX + key
+
+        return self._read(self._transaction.zrange(key, 0, 0, withscores=True),
+                          decode_lowest_score,
+                          None)
+
+    async def execute(self):
+        try:
+            await self._transaction.execute()
+        except aioredis.errors.ReplyError:
+            logger.error("Redis еще не готов")
+        except Exception:
+            logger.exception("Что-то не так с хранилищем")
+
+        for raw_result, decode, default, result in self._reads:
+            try:
+                result.set_result(decode(await raw_result, default))
+            except Exception:
+                result.set_result(default)
+
+
 class StorageRedis:
     """
     Functions to safe read/write to redis
@@ -31,27 +189,24 @@ class StorageRedis:
     @classmethod
     async def create(cls, prefix: str):
         self = StorageRedis(prefix)
-
-        self._redis = await aioredis.create_redis(
-            f'redis://{config.REDIS_HOST}:{config.REDIS_PORT}',
-            password=config.REDIS_PASSWORD)
-
+        self._redis = await redis_pool.get()
         return self
 
     def __init__(self, prefix: str):
         self.PREFIX = prefix
         self._redis: Redis
 
+    @asynccontextmanager
+    async def batch(self, prefix: str = '') -> AsyncIterator[StorageBatch]:
+        batch = StorageBatch(self._redis, self.PREFIX + prefix)
+        yield batch
+        await batch.execute()
+
     @safe_redis
     async def get_value(self, key: str, default: Any = dict()) -> Any:
         key = self.PREFIX + key
-
-        if await self._redis.exists(key):
-            raw_value = await self._redis.get(key)
-            value: dict = json.loads(raw_value)
-            return value or default
-        else:
-            return default
+        raw_value = await self._redis.get(key)
+        return decode_value(raw_value, default)
 
     @safe_redis
     async def set_value(self, key: str, value: Any):
@@ -59,6 +214,47 @@ class StorageRedis:
         raw_value = json.dumps(value)
         await self._redis.set(key, raw_value)
 
+    @safe_redis
+    async def set_expiring_value(self, key: str, value: Any, expire: int):
+        key = self.PREFIX + key
+        raw_value = json.dumps(value)
+        await self._redis.set(key, raw_value, expire=expire)
+
+    @safe_redis
+    async def get_compressed_value(self,
+                                   key: str,
+                                   default: Any = dict()) -> Any:
+        key = self.PREFIX + key
+        raw_value = await self._redis.get(key)
+        return decode_compressed_value(raw_value, default)
+
+    @safe_redis
+    async def set_compressed_value(self, key: str, value: Any, expire: int):
+        """
+        For big rarely read values, stored compressed and expiring
+        """
+        key = self.PREFIX + key
+        raw_value = encode_compressed_value(value)
+        await self._redis.set(key, raw_value, expire=expire)
+
+    @safe_redis
+    async def add_value(self, key: str, value: Any, expire: int) -> bool:
+        """
+        Sets value only if there is no such key yet
+        """
+        key = self.PREFIX + key
+        raw_value = json.dumps(value)
+
+        return await self._redis.set(key,
+                                     raw_value,
+                                     expire=expire,
+                                     exist=self._redis.SET_IF_NOT_EXIST)
+
+    @safe_redis
+    async def expire(self, key: str, seconds: int):
+        key = self.PREFIX + key
+        await self._redis.expire(key, seconds)
+
     @safe_redis
     async def add_set_member(self, key: str, value: Any, *values):
         key = self.PREFIX + key
@@ -68,16 +264,48 @@ class StorageRedis:
     @safe_redis
     async def get_set(self, key: str, default: Any = ()) -> Any:
         key = self.PREFIX + key
+        raw_values = await self._redis.smembers(key)
+        return decode_set(raw_values, default)
 
-        if await self._redis.exists(key):
-            raw_values = await self._redis.smembers(key)
+    @safe_redis
+    async def get_hash(self, key: str, default: Any = dict()) -> Any:
+        key = self.PREFIX + key
+        raw_values = await self._redis.hgetall(key)
+        return decode_hash(raw_values, default)
 
-            value = list(map(lambda raw_value: raw_value.decode('utf8'),
-                             raw_values))
+    @safe_redis
+    async def get_hash_value(self,
+                             key: str,
+                             field: str,
+                             default: Any = None) -> Any:
+        key = self.PREFIX + key
+        raw_value = await self._redis.hget(key, field)
+        return decode_hash_value(raw_value, default)
 
-            return value or default
-        else:
-            return default
+    @safe_redis
+    async def publish(self, channel: str, message: Any):
+        channel = self.PREFIX + channel
+        await self._redis.publish_json(channel, message)
+
+    async def subscribe(self, channel: str) -> aioredis.Channel:
+        """
+        Messages are read from the returned channel, connection errors
+        are up to the caller
+        """
+        channel = self.PREFIX + channel
+        subscription, = await self._redis.subscribe(channel)
+        return subscription
+
+    @safe_redis
+    async def get_lowest_score(self, key: str) -> Optional[float]:
+        key = self.PREFIX + key
+        members = await self._redis.zrange(key, 0, 0, withscores=True)
+        return decode_lowest_score(members, None)
+
+    @safe_redis
+    async def run_script(self, script: str, keys: list, args: list) -> Any:
+        keys = list(map(lambda key: self.PREFIX + key, keys))
+        return await self._redis.eval(script, keys=keys, args=args)
 
     @safe_redis
     async def delete(self, key: str, *keys):
@@ -86,13 +314,31 @@ class StorageRedis:
         await self._redis.delete(*keys)
 
     @safe_redis
-    async def keys(self, pattern: str):
-        pattern = self.PREFIX + pattern
-        return await self._redis.keys(pattern)
+    async def keys(self, pattern: str) -> list:
+        found_keys = []
+
+        async for keys in self._scan(pattern):
+            found_keys.extend(keys)
+
+        return found_keys
 
     @safe_redis
     async def delete_by_pattern(self, pattern: str):
-        keys = await self.keys(pattern)
+        async for keys in self._scan(pattern):
+            if keys:
+                await self._redis.unlink(*keys)
+
+    async def _scan(self, pattern: str) -> AsyncIterator[list]:
+        """
+        Incremental replacement for KEYS, which blocks whole redis
+        """
+        pattern = self.PREFIX + pattern
+        cur = b'0'  # set initial cursor to 0
+
+        while cur:
+            cur, keys = await self._redis.scan(
+                cur,
+                match=pattern,
+                count=config.REDIS_SCAN_BATCH_SIZE)
 
-        if keys:
-            await self._redis.delete(*keys)
+            yield keys
@@ -1,5 +1,5 @@
-from typing import Any
-from storage_redis import StorageRedis
+from typing import Any, AsyncContextManager
+from storage_redis import StorageBatch, StorageRedis
 
 
 PREFIX = 'user_storage'
@@ -19,6 +19,9 @@ class UserStorage:
     def __init__(self):
         self._redis: StorageRedis
 
+    def batch(self, user_id: int) -> AsyncContextManager[StorageBatch]:
+        return self._redis.batch(prefix=f'{str(user_id)}:')
+
     async def get(self, user_id: int, key: str) -> Any:
         composite_key = f'{str(user_id)}:{key}'
         return await self._redis.get_value(composite_key)
@@ -42,9 +45,11 @@ class UserStorage:
         composite_key = f'{str(user_id)}:{key}'
         return await self._redis.add_set_member(composite_key, value, *values)
 
-    async def delete(self, user_id: int, key: str):
-        composite_key = f'{str(user_id)}:{key}'
-        return await self._redis.delete(composite_key)
+    async def delete(self, user_id: int, key: str, *keys):
+        composite_keys = map(lambda key: f'{str(user_id)}:{key}',
+                             (key, *keys))
+
+        return await self._redis.delete(*composite_keys)
 
     async def delete_by_pattern(self, user_id: int, pattern: str):
         composite_pattern = f'{str(user_id)}:{pattern}'
@@ -1,67 +1,305 @@
+import asyncio
 import json
-from typing import AsyncGenerator
+import logging
+from typing import (AsyncGenerator, Dict, Iterable, List, Optional, Tuple,
+                    Union)
 
-import aioredis
+from aioredis import Redis
 
 import config
+import redis_pool
 
+logger = logging.getLogger(__name__)
 
-async def verified():
-    redis = await aioredis.create_redis(
-        f'redis://{config.REDIS_HOST}:{config.REDIS_PORT}',
-        password=config.REDIS_PASSWORD)
+# data saved by previous versions as a single json blob
+FSM_DATA_PATTERN = 'fsm:*:*:data'
 
-    keys = []
-    cur = b'0'  # set initial cursor to 0
+# data saved as hashes
+FSM_FIELDS_PATTERN = 'fsm:*:*:fields'
 
-    while cur:
-        cur, keys = await redis.scan(cur, match='fsm:*:*:data')
+# ids of users having any data
+USERS_INDEX = 'users_index:all'
+
+# ids of users with verified email
+VERIFIED_INDEX = 'users_index:verified'
+
+
+# KEYS - user data, USERS_INDEX, VERIFIED_INDEX, ARGV - user id
+# user is unindexed only if nothing has written the data meanwhile
+UNINDEX_IF_EMPTY = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+"""
+
+
+def data_key(user_id: Union[str, int],
+             chat_id: Union[str, int, None] = None) -> str:
+    """
+    Bot talks to users in private chats only, where chat id is user id, so
+    the index and batch reads find data by user id alone
+    """
+    if chat_id is None:
+        chat_id = user_id
+
+    return f'fsm:{chat_id}:{user_id}:fields'
+
+
+def encode_fields(user_data: dict) -> Dict[str, str]:
+    return {field: json.dumps(value) for field, value in user_data.items()}
+
+
+def decode_fields(raw_fields: Dict[str, Optional[str]]) -> dict:
+    user_data = {}
+
+    for field, raw_value in raw_fields.items():
+        if raw_value is not None:
+            user_data[field] = json.loads(raw_value)
+
+    return user_data
+
+
+def index_user(redis: Redis, user_id: Union[str, int], user_data: dict):
+    """
+    Commands are not awaited to be usable inside transactions
+    """
+    redis.sadd(USERS_INDEX, user_id)
+    index_verified(redis, user_id, user_data.get('verified', False))
+
+
+def index_changed_fields(redis: Redis,
+                         user_id: Union[str, int],
+                         changed: dict,
+                         removed: Iterable[str]):
+    """
+    Same as index_user for partial writes, verified index is touched only
+    if the verified field itself is written
+    """
+    redis.sadd(USERS_INDEX, user_id)
+
+    if 'verified' in changed:
+        index_verified(redis, user_id, changed['verified'])
+    elif 'verified' in removed:
+        index_verified(redis, user_id, False)
+
+
+def index_verified(redis: Redis, user_id: Union[str, int], verified: bool):
+    if verified:
+        redis.sadd(VERIFIED_INDEX, user_id)
+    else:
+        redis.srem(VERIFIED_INDEX, user_id)
+
+
+def unindex_user(redis: Redis, user_id: Union[str, int]):
+    redis.srem(USERS_INDEX, user_id)
+    redis.srem(VERIFIED_INDEX, user_id)
+
+
+def unindex_user_if_empty(redis: Redis,
+                          user_id: Union[str, int],
+                          key: str):
+    redis.eval(UNINDEX_IF_EMPTY,
+               keys=[key, USERS_INDEX, VERIFIED_INDEX],
+               args=[user_id])
+
+
+async def id_pages(
+        index: str = USERS_INDEX,
+        page_size: int = config.REDIS_SCAN_BATCH_SIZE,
+        cursor: int = 0) -> AsyncGenerator[Tuple[int, List[int]], None]:
+    """
+    Yields next cursor with a page of user ids. Iteration could be resumed
+    later from any returned cursor, zero cursor means the end.
+    """
+    redis = await redis_pool.get()
+
+    while True:
+        cursor, user_ids = await redis.sscan(index, cursor, count=page_size)
+        yield cursor, list(map(int, user_ids))
+
+        if not cursor:
+            return
+
+
+async def data_pages(
+        index: str = USERS_INDEX,
+        page_size: int = config.REDIS_SCAN_BATCH_SIZE,
+        fields: Optional[Iterable[str]] = None,
+        cursor: int = 0) \
+        -> AsyncGenerator[Tuple[int, List[Tuple[int, dict]]], None]:
+    """
+    Same as id_pages but with users data fetched by one pipeline per page.
+    Only listed fields are read if fields are set.
+    """
+    redis = await redis_pool.get()
+
+    async for cursor, user_ids in id_pages(index, page_size, cursor):
+        page = []
+
+        if user_ids:
+            values = await _read_fields(redis, user_ids, fields)
+
+            for user_id, raw_fields in zip(user_ids, values):
+                if user_data := decode_fields(raw_fields):
+                    page.append((user_id, user_data))
+
+        yield cursor, page
 
-        for key in keys:
-            val = await redis.get(key)
-            user_data: dict = json.loads(val)
-            user_verified = user_data.get('verified', False)
 
-            if user_verified:
-                yield user_data
+async def _read_fields(redis: Redis,
+                       user_ids: List[int],
+                       fields: Optional[Iterable[str]]) \
+        -> List[Dict[str, Optional[str]]]:
+    pipeline = redis.pipeline()
 
-    redis.close()
+    if fields is None:
+        for user_id in user_ids:
+            pipeline.hgetall(data_key(user_id), encoding='utf8')
 
+        return await pipeline.execute()
 
-async def every_id() -> AsyncGenerator[int, int]:
-    redis = await aioredis.create_redis(
-        f'redis://{config.REDIS_HOST}:{config.REDIS_PORT}',
-        password=config.REDIS_PASSWORD)
+    fields = list(fields)
 
-    keys = []
+    for user_id in user_ids:
+        pipeline.hmget(data_key(user_id), *fields, encoding='utf8')
+
+    return [dict(zip(fields, values)) for values in await pipeline.execute()]
+
+
+async def verified(page_size: int = config.REDIS_SCAN_BATCH_SIZE,
+                   fields: Optional[Iterable[str]] = None):
+    async for _, page in data_pages(VERIFIED_INDEX, page_size, fields):
+        for _, user_data in page:
+            yield user_data
+
+
+async def every_id(page_size: int = config.REDIS_SCAN_BATCH_SIZE) \
+        -> AsyncGenerator[int, int]:
+    async for _, user_ids in id_pages(USERS_INDEX, page_size):
+        for user_id in user_ids:
+            yield user_id
+
+
+async def verified_id(page_size: int = config.REDIS_SCAN_BATCH_SIZE) \
+        -> AsyncGenerator[int, int]:
+    async for _, user_ids in id_pages(VERIFIED_INDEX, page_size):
+        for user_id in user_ids:
+            yield user_id
+
+
+async def every(page_size: int = config.REDIS_SCAN_BATCH_SIZE,
+                fields: Optional[Iterable[str]] = None) \
+        -> AsyncGenerator[dict, dict]:
+    async for _, page in data_pages(USERS_INDEX, page_size, fields):
+        for _, user_data in page:
+            yield user_data
+
+
+async def count() -> int:
+    redis = await redis_pool.get()
+    return await redis.scard(USERS_INDEX)
+
+
+async def count_verified() -> int:
+    redis = await redis_pool.get()
+    return await redis.scard(VERIFIED_INDEX)
+
+
+async def backfill_index():
+    """
+    One-off filling of users index from FSM data saved before the index
+    appeared. Data is moved from json blobs to hashes on the way.
+    """
+    indexed = await _backfill_legacy_data()
+    indexed += await _backfill_fields()
+    logger.info(f'Всего проиндексировано пользователей: {indexed}')
+
+
+async def _backfill_legacy_data() -> int:
+    redis = await redis_pool.get()
+    indexed = 0
     cur = b'0'  # set initial cursor to 0
 
     while cur:
-        cur, keys = await redis.scan(cur, match='fsm:*:*:data')
+        cur, keys = await redis.scan(cur,
+                                     match=FSM_DATA_PATTERN,
+                                     count=config.REDIS_SCAN_BATCH_SIZE)
 
-        for key in keys:
-            id_data = str(key).split(':')
-            # chat_id = id_data[1]
-            user_id = id_data[2]
-            yield int(user_id)
+        if not keys:
+            continue
+
+        values = await redis.mget(*keys)
+        transaction = redis.multi_exec()
+
+        for key, val in zip(keys, values):
+            if not val:
+                continue
+
+            # fsm:chat_id:user_id:data
+            _, chat_id, user_id, _ = key.decode('utf8').split(':')
+            user_data = json.loads(val)
+            transaction.delete(key)
 
-    redis.close()
+            if user_data:
+                transaction.hmset_dict(data_key(user_id, chat_id),
+                                       encode_fields(user_data))
 
+            index_user(transaction, user_id, user_data)
+            indexed += 1
 
-async def every() -> AsyncGenerator[dict, dict]:
-    redis = await aioredis.create_redis(
-        f'redis://{config.REDIS_HOST}:{config.REDIS_PORT}',
-        password=config.REDIS_PASSWORD)
+        await transaction.execute()
+        logger.info(f'Проиндексировано пользователей: {indexed}')
 
-    keys = []
+    return indexed
+
+
+async def _backfill_fields() -> int:
+    """
+    Users whose data was already moved to hashes
+    """
+    redis = await redis_pool.get()
+    indexed = 0
     cur = b'0'  # set initial cursor to 0
 
     while cur:
-        cur, keys = await redis.scan(cur, match='fsm:*:*:data')
+        cur, keys = await redis.scan(cur,
+                                     match=FSM_FIELDS_PATTERN,
+                                     count=config.REDIS_SCAN_BATCH_SIZE)
+
+        if not keys:
+            continue
+
+        pipeline = redis.pipeline()
 
         for key in keys:
-            val = await redis.get(key)
-            user_data: dict = json.loads(val)
-            yield user_data
+            pipeline.hget(key, 'verified', encoding='utf8')
+
+        values = await pipeline.execute()
+        transaction = redis.multi_exec()
+
+        for key, raw_verified in zip(keys, values):
+            # fsm:chat_id:user_id:fields
+            user_id = key.decode('utf8').split(':')[2]
+            verified = bool(raw_verified and json.loads(raw_verified))
+
+            transaction.sadd(USERS_INDEX, user_id)
+            index_verified(transaction, user_id, verified)
+            indexed += 1
+
+        await transaction.execute()
+        logger.info(f'Проиндексировано пользователей с полями: {indexed}')
+
+    return indexed
+
+
+async def _backfill():
+    try:
+        await backfill_index()
+    finally:
+        await redis_pool.close()
+
 
-    redis.close()
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.get_event_loop().run_until_complete(_backfill())